@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for YtDlpOutputParser over the recorded yt-dlp log in
+bench/data, expanded with progress lines and -v style "[debug]" noise.
+Compares it with the per-line regex scan the CLI engine used before.
+
+    python bench/parser_benchmark.py
+    python bench/parser_benchmark.py --progress-lines 5000 --debug-lines 50000
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import shazam_downloader as sd
+
+SAMPLE = os.path.join(BENCH_DIR, "data", "yt_dlp_sample.log")
+
+def build_lines(progress_lines, debug_lines):
+    progress = []
+    per_step = debug_lines // max(progress_lines, 1)
+    for i in range(progress_lines):
+        percent = 100.0 * i / max(progress_lines, 1)
+        progress.append(f"[download]  {percent:5.1f}% of    3.28MiB at  1.52MiB/s ETA 00:02")
+        progress.extend(f"[debug] fragment {i}.{j}: socket read 16384 bytes" for j in range(per_step))
+    with open(SAMPLE, encoding="utf-8") as f:
+        sample = f.read()
+    sample = sample.replace("{query}", "ytsearch:Bench Song").replace("{base}", "/tmp/Bench Song")
+    return sample.replace("{ext}", "mp3").replace("{progress}", "\n".join(progress)).splitlines()
+
+def legacy_scan(lines):
+    """The old handle_line: one uncompiled re.search per pattern per line"""
+    events = 0
+    for line in lines:
+        if re.search(r"\[download\]\s+(\d+\.\d+)%", line):
+            events += 1
+            re.search(r"of\s+~?\s*([\d.]+)([KMG]?i?B)\b", line)
+        re.match(r"\[youtube\] ([\w-]{11}): ", line)
+        re.match(r"\[info\] [\w-]{11}: Downloading \d+ format\(s\): (\S+)", line)
+        if re.search(r"\[download\] Destination: (.+)", line):
+            events += 1
+        re.search(r"\[Merger\].+: (.+)", line)
+        re.search(r"\[ffmpeg\] Merging formats into \"(.+)\"", line)
+        if re.search(r"\[ExtractAudio\] Destination: (.+)", line):
+            events += 1
+    return events
+
+def parser_scan(lines):
+    parser = sd.YtDlpOutputParser()
+    events = 0
+    for line in lines:
+        events += len(parser.feed(line))
+    return events + len(parser.finish())
+
+def best_of(func, lines, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(lines)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--progress-lines", type=int, default=1000)
+    parser.add_argument("--debug-lines", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5, help="runs per implementation; the best is reported")
+    args = parser.parse_args()
+
+    lines = build_lines(args.progress_lines, args.debug_lines)
+    print(f"{len(lines)} lines, best of {args.repeat}")
+    for name, func in (("legacy regex scan", legacy_scan), ("YtDlpOutputParser", parser_scan)):
+        elapsed = best_of(func, lines, args.repeat)
+        print(f"  {name:<20}{elapsed * 1000:8.1f}ms  {len(lines) / elapsed / 1e6:6.2f}M lines/s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks for shazam_downloader.py.
+
+Runs the listener and the download pipeline end-to-end against the stub
+Termux:API and yt-dlp executables in bench/stubs, so no phone, Shazam or
+network is needed. Everything happens inside a throwaway HOME directory.
+
+    python bench/run_benchmarks.py
+    python bench/run_benchmarks.py --jobs 50 --workers 4 --line-delay 0.001 --debug-lines 2000
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+STUBS_DIR = os.path.join(BENCH_DIR, "stubs")
+NOTIFICATIONS_SAMPLE = os.path.join(BENCH_DIR, "data", "notifications.json")
+
+# Results always go to the real stdout; the script's own console output is
+# silenced unless --verbose is given (it still lands in the temp HOME's log)
+_report_stream = sys.stdout
+
+def report(line=""):
+    print(line, file=_report_stream, flush=True)
+
+def prepare_environment(args):
+    """Point HOME, PATH and the stub settings at a temp dir, then import the module"""
+    home = tempfile.mkdtemp(prefix="shazam-bench-")
+    shade_file = os.path.join(home, "shade.json")
+    shutil.copy(NOTIFICATIONS_SAMPLE, shade_file)
+
+    os.environ.update({
+        "HOME": home,
+        "PATH": STUBS_DIR + os.pathsep + os.environ.get("PATH", ""),
+        "SHAZAM_DL_ENGINE": "cli",  # The stub replaces the yt-dlp executable
+        "BENCH_CALL_LOG": os.path.join(home, "calls.log"),
+        "BENCH_NOTIFICATIONS": shade_file,
+        "BENCH_NOTIFICATION_PADDING": str(args.shade_padding),
+        "BENCH_YTDLP_PROGRESS_LINES": str(args.progress_lines),
+        "BENCH_YTDLP_DEBUG_LINES": str(args.debug_lines),
+        "BENCH_YTDLP_LINE_DELAY": str(args.line_delay),
+        "BENCH_YTDLP_FILE_SIZE": str(args.file_size),
+    })
+
+    sys.path.insert(0, REPO_DIR)
+    import shazam_downloader
+
+    music = os.path.join(home, "Music")
+    shazam_downloader.PRIMARY_SAVE_FOLDER = music
+    shazam_downloader.FALLBACK_SAVE_FOLDER = music
+    shazam_downloader.INTERNAL_SAVE_FOLDER = music
+    # Cover art comes from a local file instead of i.ytimg.com
+    cover = os.path.join(home, "cover.jpg")
+    with open(cover, "wb") as f:
+        f.write(b"\xff\xd8\xff\xe0" + bytes(2048) + b"\xff\xd9")
+    shazam_downloader.THUMBNAIL_URL = "file://" + cover
+    return shazam_downloader, home
+
+def cpu_seconds():
+    """User + system CPU time of this process and its reaped children"""
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+def summarize(values, sd):
+    values = sorted(values)
+    if not values:
+        return "n/a"
+    return (f"p50 {sd.percentile(values, 50) * 1000:.1f}ms  "
+            f"p95 {sd.percentile(values, 95) * 1000:.1f}ms  "
+            f"max {values[-1] * 1000:.1f}ms")
+
+def wait_for_call(call_log, *needles, timeout=10):
+    """Return the stub timestamp of the first logged call containing all `needles`"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with open(call_log, encoding="utf-8") as f:
+                for line in f:
+                    if all(needle in line for needle in needles):
+                        return float(line.split(" ", 1)[0])
+        except FileNotFoundError:
+            pass
+        time.sleep(0.005)
+    return None
+
+def bench_listener(sd, home, detections, idle_seconds):
+    """Detection latency (shade change -> "Song Detected" notification) and idle polling cost"""
+    shade_file = os.environ["BENCH_NOTIFICATIONS"]
+    with open(shade_file, encoding="utf-8") as f:
+        base_shade = json.load(f)
+
+    watcher = sd.NotificationWatcher(min_interval=0.05, max_interval=1.0)
+    thread = threading.Thread(target=sd.listen_for_shazam, args=(watcher,), daemon=True)
+    thread.start()
+
+    latencies = []
+    missed = 0
+    for i in range(detections):
+        title = f"Bench Song {i}"
+        shade = base_shade + [{
+            "id": 7, "tag": "", "key": "0|com.shazam.android|7|null|10400", "group": "",
+            "packageName": "com.shazam.android", "title": title, "content": "Bench Artist",
+            "when": "2024-05-01 21:15:00",
+        }]
+        tmp_path = shade_file + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(shade, f)
+        os.replace(tmp_path, shade_file)
+        written_at = time.time()
+
+        notified_at = wait_for_call(os.environ["BENCH_CALL_LOG"], "--id 200", title)
+        if notified_at is None:
+            missed += 1
+        else:
+            latencies.append(notified_at - written_at)
+
+    # Nothing changes from here on: measure what an idle listener costs
+    polls_before, parses_before = watcher.polls, watcher.parses
+    cpu_before = cpu_seconds()
+    time.sleep(idle_seconds)
+    idle_cpu = cpu_seconds() - cpu_before
+    idle_polls = watcher.polls - polls_before
+    idle_parses = watcher.parses - parses_before
+
+    watcher.stop()
+    thread.join(timeout=5)
+
+    report("Listener")
+    report(f"  detections        {len(latencies)} ok, {missed} missed")
+    report(f"  detect latency    {summarize(latencies, sd)}")
+    report(f"  idle {idle_seconds:.0f}s           {idle_polls} polls, {idle_parses} parsed, "
+           f"{idle_cpu * 1000:.0f}ms CPU")
+
+def bench_sequential(sd, jobs):
+    """Back-to-back download_song calls, as one --download process would run them"""
+    latencies = []
+    cpu_before = cpu_seconds()
+    start = time.time()
+    ok = 0
+    for i in range(jobs):
+        job_start = time.time()
+        ok += bool(sd.download_song(f"Sequential Song {i} - Bench Artist", show_progress_bar=False))
+        latencies.append(time.time() - job_start)
+    wall = time.time() - start
+    cpu = cpu_seconds() - cpu_before
+
+    report("Sequential downloads")
+    report(f"  jobs              {ok}/{jobs} ok in {wall:.2f}s ({jobs * 60 / wall:.0f} jobs/min)")
+    report(f"  latency per job   {summarize(latencies, sd)}")
+    report(f"  CPU per job       {cpu / jobs * 1000:.1f}ms")
+
+def bench_pool(sd, home, jobs, workers):
+    """The same work through the concurrent DownloadDaemon pool"""
+    daemon = sd.DownloadDaemon(workers=workers, journal=os.path.join(home, "bench_jobs.jsonl"), fifo=None)
+    daemon.start()
+    cpu_before = cpu_seconds()
+    start = time.time()
+    for i in range(jobs):
+        daemon.submit(f"Pooled Song {i} - Bench Artist")
+    daemon.wait_until_idle()
+    wall = time.time() - start
+    sd.get_tagger().drain()
+    post_wall = time.time() - start
+    cpu = cpu_seconds() - cpu_before
+    daemon.stop()
+
+    total_bytes = int(os.environ["BENCH_YTDLP_FILE_SIZE"]) * daemon.succeeded
+    report(f"Pooled downloads ({workers} workers)")
+    report(f"  jobs              {daemon.succeeded}/{jobs} ok in {wall:.2f}s ({jobs * 60 / wall:.0f} jobs/min)")
+    report(f"  throughput        {total_bytes / wall / 1e6:.1f} MB/s of output files")
+    report(f"  CPU per job       {cpu / jobs * 1000:.1f}ms")
+    report(f"  tagged + scanned  {post_wall:.2f}s after the first submit, "
+           f"{count_calls('termux-media-scan', since=start)} media scan call(s)")
+
+def count_calls(command, since=0.0):
+    """Number of stub calls to `command` logged at or after `since`"""
+    count = 0
+    try:
+        with open(os.environ["BENCH_CALL_LOG"], encoding="utf-8") as f:
+            for line in f:
+                stamp, _, rest = line.partition(" ")
+                if rest.startswith(command + " ") and float(stamp) >= since:
+                    count += 1
+    except FileNotFoundError:
+        pass
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=int, default=10, help="downloads per download benchmark")
+    parser.add_argument("--workers", type=int, default=3, help="pool size for the pooled benchmark")
+    parser.add_argument("--detections", type=int, default=5, help="Shazam detections to simulate")
+    parser.add_argument("--idle-seconds", type=float, default=3.0, help="idle listener measurement window")
+    parser.add_argument("--shade-padding", type=int, default=20, help="extra notifications in the shade")
+    parser.add_argument("--progress-lines", type=int, default=200, help="yt-dlp progress lines per job")
+    parser.add_argument("--debug-lines", type=int, default=0, help="yt-dlp [debug] lines per job")
+    parser.add_argument("--line-delay", type=float, default=0.0, help="seconds between yt-dlp lines")
+    parser.add_argument("--file-size", type=int, default=4 * 1024 * 1024, help="bytes per downloaded file")
+    parser.add_argument("--keep", action="store_true", help="keep the temp HOME for inspection")
+    parser.add_argument("--verbose", action="store_true", help="show the script's own console output")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+
+    sd, home = prepare_environment(args)
+    report(f"Benchmark HOME: {home}")
+    report()
+    try:
+        bench_listener(sd, home, args.detections, args.idle_seconds)
+        report()
+        bench_sequential(sd, args.jobs)
+        report()
+        bench_pool(sd, home, args.jobs, args.workers)
+        sd.get_notifier().flush()
+    finally:
+        if not args.keep:
+            shutil.rmtree(home, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,18 @@ import os
 import sys
 import re
 import shutil
+import shlex
+import errno
+import queue
+import threading
+import selectors
+import signal
+import atexit
+import hashlib
+from collections import OrderedDict, namedtuple
 import traceback
+import math
+import logging
 
 # Directory to save songs - with alternative options
 PRIMARY_SAVE_FOLDER = "/storage/emulated/0/Music"
@@ -15,24 +26,340 @@ INTERNAL_SAVE_FOLDER = os.path.join(os.path.expanduser("~"), "Music")
 # Create a log file for debugging
 LOG_FILE = os.path.join(os.path.expanduser("~"), "shazam_downloader.log")
 
-def log_message(message):
+# Log verbosity (DEBUG, INFO, WARNING, ...) and size-based rotation
+LOG_LEVEL = os.environ.get("SHAZAM_DL_LOG_LEVEL", "INFO").upper()
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUP_COUNT = 3
+
+# Per-job yt-dlp output logs kept in JOB_OUTPUT_DIR
+JOB_LOGS_KEPT = 100
+
+# yt-dlp's own -v debug output is opt-in; it multiplies the output volume
+YTDLP_VERBOSE = os.environ.get("SHAZAM_DL_VERBOSE", "0") == "1"
+
+# Persistent state for the download daemon (job journal and enqueue FIFO)
+STATE_DIR = os.path.join(os.path.expanduser("~"), ".shazam_downloader")
+JOB_JOURNAL = os.path.join(STATE_DIR, "jobs.jsonl")
+QUEUE_FIFO = os.path.join(STATE_DIR, "queue.fifo")
+BATCH_DIR = os.path.join(STATE_DIR, "batches")
+JOB_OUTPUT_DIR = os.path.join(STATE_DIR, "output")
+SONG_INDEX_FILE = os.path.join(STATE_DIR, "songs.jsonl")
+SEARCH_CACHE_FILE = os.path.join(STATE_DIR, "search_cache.json")
+CAPABILITY_CACHE_FILE = os.path.join(STATE_DIR, "capabilities.json")
+LIBRARY_INDEX_FILE = os.path.join(STATE_DIR, "library_index.json")
+METRICS_FILE = os.path.join(STATE_DIR, "metrics.jsonl")
+
+# Number of most recent jobs summarized by --stats
+STATS_WINDOW = 200
+
+# Resolved ytsearch results are reused for a week, keeping the most recent entries
+SEARCH_CACHE_TTL = 7 * 24 * 3600
+SEARCH_CACHE_MAX_ENTRIES = 500
+
+# Detected songs are resolved in the background before the Download tap;
+# a result is used for PREFETCH_WINDOW seconds and at most
+# PREFETCH_MAX_ENTRIES are kept in memory
+PREFETCH_ENABLED = os.environ.get("SHAZAM_DL_PREFETCH", "1") != "0"
+PREFETCH_WINDOW = 600
+PREFETCH_MAX_ENTRIES = 3
+# How long a download waits for a prefetch still running before searching itself
+PREFETCH_TAKE_TIMEOUT = 5
+
+# Bytes read from each end of a library file for its content fingerprint
+LIBRARY_HASH_CHUNK = 64 * 1024
+
+# Command that dumps the notification shade as JSON; point it at a fake for testing
+NOTIFICATION_LIST_CMD = shlex.split(os.environ.get("SHAZAM_NOTIFICATION_LIST_CMD", "termux-notification-list"))
+SHAZAM_PACKAGE = "com.shazam.android"
+
+# Notification polling cadence (seconds): fast right after a Shazam hit,
+# backing off geometrically while the shade is idle
+POLL_INTERVAL_MIN = 1.0
+POLL_INTERVAL_MAX = 10.0
+POLL_BACKOFF_FACTOR = 1.5
+
+# Minimum spacing between Termux:API notification calls (seconds)
+NOTIFICATION_MIN_INTERVAL = 0.25
+
+# yt-dlp watchdog (seconds): a job that prints nothing for the inactivity
+# timeout or exceeds the total deadline is terminated, then killed after the
+# grace period. ffmpeg is silent while it converts, so post-processing is
+# held to the total deadline only.
+YTDLP_INACTIVITY_TIMEOUT = int(os.environ.get("SHAZAM_DL_INACTIVITY_TIMEOUT", "30"))
+YTDLP_TOTAL_TIMEOUT = int(os.environ.get("SHAZAM_DL_TOTAL_TIMEOUT", "900"))
+YTDLP_KILL_GRACE = 5
+
+# Failed attempts are retried with exponential backoff and jitter, resuming
+# partial downloads; unavailable videos fall over to the next of
+# SEARCH_CANDIDATES search results
+RETRY_MAX_ATTEMPTS = max(1, int(os.environ.get("SHAZAM_DL_RETRIES", "4")))
+RETRY_BASE_DELAY = 2
+RETRY_MAX_DELAY = 60
+SEARCH_CANDIDATES = 3
+
+# Network detection commands (JSON output, Termux:API style); override to test
+WIFI_INFO_CMD = shlex.split(os.environ.get("SHAZAM_WIFI_INFO_CMD", "termux-wifi-connectioninfo"))
+TELEPHONY_INFO_CMD = shlex.split(os.environ.get("SHAZAM_TELEPHONY_INFO_CMD", "termux-telephony-deviceinfo"))
+NETWORK_RECHECK_INTERVAL = 60
+
+# Transfer settings per connection type. aria2c is used when installed and
+# the profile has aria2c arguments; "unknown" is treated like mobile data.
+NETWORK_PROFILES = {
+    "wifi": {
+        "concurrent_fragments": 16,
+        "chunk_size": "1M",
+        "rate_limit": None,
+        "aria2c_args": "-x 16 -s 16 -k 1M",
+    },
+    "mobile": {
+        "concurrent_fragments": 4,
+        "chunk_size": "500K",
+        "rate_limit": os.environ.get("SHAZAM_MOBILE_RATE_LIMIT") or None,
+        "aria2c_args": "-x 4 -s 4 -k 512K",
+    },
+}
+NETWORK_PROFILES["unknown"] = NETWORK_PROFILES["mobile"]
+
+# On mobile data, workers pause while more than this many jobs are
+# waiting or running, until Wi-Fi comes back
+METERED_QUEUE_LIMIT = 3
+
+# Concurrent search resolutions during a batch import
+BATCH_RESOLVE_WORKERS = 4
+
+# "mp3" re-encodes every download with ffmpeg/LAME; "native" keeps the best
+# audio stream as-is (remuxed to .m4a/.opus, no re-encode)
+AUDIO_FORMAT = os.environ.get("SHAZAM_DL_AUDIO_FORMAT", "mp3").lower()
+AUDIO_CODEC = "best" if AUDIO_FORMAT == "native" else "mp3"
+AUDIO_EXTENSIONS = (".mp3", ".m4a", ".opus", ".ogg", ".aac", ".flac", ".wav")
+
+# Optional background MP3 conversion of native downloads. It runs at the
+# lowest CPU priority, only while charging or while no download is running.
+TRANSCODE_TO_MP3 = AUDIO_FORMAT == "native" and os.environ.get("SHAZAM_DL_TRANSCODE", "0") == "1"
+TRANSCODE_WORKERS = 1
+TRANSCODE_RECHECK_INTERVAL = 30
+BATTERY_STATUS_CMD = shlex.split(os.environ.get("SHAZAM_BATTERY_STATUS_CMD", "termux-battery-status"))
+
+# Finished files get the Shazam title/artist, detection time, source URL and
+# the video thumbnail as cover art written into their tags
+TAGGING_ENABLED = os.environ.get("SHAZAM_DL_TAGS", "1") != "0"
+TAG_WORKERS = 2
+THUMBNAIL_URL = "https://i.ytimg.com/vi/{video_id}/hqdefault.jpg"
+THUMBNAIL_TIMEOUT = 15
+SOURCE_URL = "https://www.youtube.com/watch?v={video_id}"
+
+# Media scanner requests are collected for a moment and sent in one call
+MEDIA_SCAN_DELAY = 2.0
+MEDIA_SCAN_BATCH = 50
+MEDIA_SCANNER_ACTION = "android.intent.action.MEDIA_SCANNER_SCAN_FILE"
+
+# Hidden folder inside the save folder that holds per-job download folders
+JOB_TEMP_DIRNAME = ".shazam-tmp"
+PARTIAL_SUFFIXES = (".part", ".ytdl", ".temp", ".tmp")
+
+# Number of yt-dlp jobs the daemon runs at once
+MAX_CONCURRENT_DOWNLOADS = max(1, int(os.environ.get("SHAZAM_DL_WORKERS", "3")))
+
+# Notification IDs: each worker slot gets its own progress/result pair,
+# plus one summary notification for the whole queue
+SUMMARY_NOTIFICATION_ID = 203
+PROGRESS_NOTIFICATION_BASE = 300
+RESULT_NOTIFICATION_BASE = 400
+
+_logger = None
+_logger_lock = threading.Lock()
+
+def get_logger():
+    """
+    Set up logging on first use: records go through a queue to a background
+    thread that prints them and appends them to the size-rotated LOG_FILE, so
+    callers never wait on disk I/O
+    """
+    global _logger
+    with _logger_lock:
+        if _logger is not None:
+            return _logger
+
+        import logging.handlers  # Pulls in socket and pickle; only load it when something logs
+
+        # Checked before anything starts, so a typo can't leave logging half set up
+        level = logging.getLevelName(LOG_LEVEL)
+        valid_level = isinstance(level, int)
+        if not valid_level:
+            level = logging.INFO
+
+        formatter = logging.Formatter("[%(asctime)s] %(message)s", "%Y-%m-%d %H:%M:%S")
+        console = logging.StreamHandler(sys.stdout)
+        console.setFormatter(formatter)
+        handlers = [console]
+        try:
+            file_handler = logging.handlers.RotatingFileHandler(
+                LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+                encoding="utf-8", delay=True)
+            file_handler.setFormatter(formatter)
+            handlers.append(file_handler)
+        except Exception as e:
+            print(f"Error opening log file: {e}")
+
+        log_queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(log_queue, *handlers)
+        listener.start()
+        atexit.register(listener.stop)  # Drains the queue before exit
+
+        logger = logging.getLogger("shazam_downloader")
+        logger.setLevel(level)
+        logger.propagate = False
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        if not valid_level:
+            logger.warning(f"Unknown SHAZAM_DL_LOG_LEVEL {LOG_LEVEL!r}, logging at INFO")
+        _logger = logger
+        return _logger
+
+def log_message(message, level=logging.INFO):
     """Write message to log file and print to console"""
-    timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-    log_entry = f"[{timestamp}] {message}"
-    
-    print(log_entry)
-    
-    try:
-        with open(LOG_FILE, "a", encoding="utf-8") as f:
-            f.write(log_entry + "\n")
-    except Exception as e:
-        print(f"Error writing to log: {e}")
+    get_logger().log(level, message)
+
+class CapabilityCache:
+    """
+    Remembers what probing the environment found, so startup doesn't spawn
+    tools or write test files every time: the usable save folder, and the
+    path, mtime and version of each external tool. A tool entry is trusted
+    while its binary's mtime (and PATH) are unchanged, and a missing tool is
+    remembered until one of the PATH folders changes; callers invalidate
+    entries that turn out to be wrong.
+    """
+
+    def __init__(self, path=CAPABILITY_CACHE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.data = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log_message(f"Error reading capability cache: {e}")
+        if self.data.get("env_path") != os.environ.get("PATH", ""):
+            self.data["env_path"] = os.environ.get("PATH", "")
+            self.data["tools"] = {}
+        self.data.setdefault("tools", {})
+
+    def save_folder(self, candidates):
+        """
+        Return the cached save folder if it is still a writable folder picked
+        from `candidates` and no folder listed before it has become usable
+        (e.g. shared storage after termux-setup-storage)
+        """
+        entry = self.data.get("save_folder")
+        if not entry or entry["candidates"] != list(candidates) or entry["path"] not in candidates \
+                or not os.path.isdir(entry["path"]) or not os.access(entry["path"], os.W_OK | os.X_OK):
+            return None
+        for folder in candidates[:candidates.index(entry["path"])]:
+            # A missing folder counts as usable when it could be created
+            target = folder if os.path.isdir(folder) else os.path.dirname(folder)
+            if os.path.isdir(target) and os.access(target, os.W_OK | os.X_OK):
+                return None
+        return entry["path"]
+
+    def set_save_folder(self, folder, candidates):
+        with self.lock:
+            self.data["save_folder"] = {"path": folder, "candidates": list(candidates)}
+            self._save()
+
+    def tool(self, name, version_args=None):
+        """
+        Return {"path", "mtime_ns", "version"} for an executable on PATH, or
+        None when it is missing or broken. With `version_args` the version is
+        read by running the tool, but only when its binary has changed.
+        """
+        cached = self.data["tools"].get(name)
+        if cached and cached.get("path") is None:
+            if cached.get("path_mtime_ns") == self._path_mtime():
+                return None
+        elif cached and (version_args is None or cached.get("version")):
+            try:
+                if os.stat(cached["path"]).st_mtime_ns == cached["mtime_ns"]:
+                    return cached
+            except OSError:
+                pass
+
+        path = shutil.which(name)
+        entry = None
+        if path is not None:
+            entry = {"path": path, "mtime_ns": os.stat(path).st_mtime_ns, "version": None}
+            if version_args is not None:
+                try:
+                    result = subprocess.run([path, *version_args], capture_output=True, text=True,
+                                            timeout=60)
+                    if result.returncode != 0:
+                        raise RuntimeError(result.stderr.strip()[-200:] or f"exit code {result.returncode}")
+                    entry["version"] = result.stdout.strip().split("\n")[0]
+                except Exception as e:
+                    log_message(f"{name} is not working: {e}")
+                    entry = None
+        # Missing and broken tools are cached too, so they aren't searched for on every use
+        record = entry if entry is not None else {"path": None, "path_mtime_ns": self._path_mtime()}
+        with self.lock:
+            if self.data["tools"].get(name) != record:
+                self.data["tools"][name] = record
+                self._save()
+        return entry
+
+    def _path_mtime(self):
+        """Newest mtime of the PATH folders; installing or removing a tool changes it"""
+        newest = 0
+        for folder in os.environ.get("PATH", "").split(os.pathsep):
+            try:
+                newest = max(newest, os.stat(folder or ".").st_mtime_ns)
+            except OSError:
+                pass
+        return newest
+
+    def invalidate(self, name):
+        """Forget a tool (or "save_folder") so the next lookup probes it again"""
+        with self.lock:
+            if name == "save_folder":
+                changed = self.data.pop("save_folder", None) is not None
+            else:
+                changed = self.data["tools"].pop(name, None) is not None
+            if changed:
+                self._save()
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.data, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            log_message(f"Error writing capability cache: {e}")
+
+_capabilities = None
+_capabilities_lock = threading.Lock()
+
+def get_capabilities():
+    """Load the capability cache on first use"""
+    global _capabilities
+    with _capabilities_lock:
+        if _capabilities is None:
+            _capabilities = CapabilityCache()
+        return _capabilities
 
 # Determine the best save folder to use
 def get_save_folder():
     """Determine the best folder to use for saving songs"""
     folders = [PRIMARY_SAVE_FOLDER, FALLBACK_SAVE_FOLDER, INTERNAL_SAVE_FOLDER]
-    
+
+    # A folder that passed the write test before is trusted while it stays
+    # writable and no preferred folder has become available
+    capabilities = get_capabilities()
+    cached_folder = capabilities.save_folder(folders)
+    if cached_folder:
+        log_message(f"Using save folder: {cached_folder}", logging.DEBUG)
+        return cached_folder
+
     for folder in folders:
         try:
             if not os.path.exists(folder):
@@ -46,6 +373,7 @@ def get_save_folder():
             os.remove(test_file)
             
             log_message(f"Using save folder: {folder}")
+            capabilities.set_save_folder(folder, folders)
             return folder
         except Exception as e:
             log_message(f"Cannot use folder {folder}: {e}")
@@ -54,9 +382,361 @@ def get_save_folder():
     log_message(f"All save folders failed, using current directory")
     return os.getcwd()
 
-# Track detected songs to avoid duplicate notifications
+# Track detected songs to avoid duplicate notifications in this session;
+# the persistent SongIndex remembers them across restarts
 detected_songs = set()
 
+# Bracketed suffixes that don't identify a track, e.g. "(Official Video)"
+_NOISE_SUFFIX_RE = re.compile(
+    r"[\(\[][^\)\]]*\b(official|video|audio|lyrics?|visuali[sz]er|hd|hq|4k|remaster(ed)?)\b[^\)\]]*[\)\]]")
+_NON_WORD_RE = re.compile(r"[\W_]+")
+
+def normalize_song_key(song_name):
+    """Normalize a "title - artist" string so trivially different spellings match"""
+    key = _NOISE_SUFFIX_RE.sub(" ", song_name.casefold())
+    return " ".join(_NON_WORD_RE.sub(" ", key).split())
+
+class SongIndex:
+    """
+    Persistent index of detected and downloaded songs, keyed by normalized
+    title/artist. Stored as an append-only JSONL file and held in memory as a
+    dict so lookups are O(1).
+    """
+
+    def __init__(self, path=SONG_INDEX_FILE):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        lines = 0
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # Torn write from a crash
+                    self.entries.setdefault(record["key"], {}).update(record)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            log_message(f"Error reading song index: {e}")
+            return
+
+        # Superseded updates pile up in the log; rewrite it once it's mostly stale
+        if lines > 2 * len(self.entries) + 100:
+            self._compact()
+
+    def _compact(self):
+        try:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry) + "\n")
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            log_message(f"Error compacting song index: {e}")
+
+    def get(self, song_name):
+        """Return the index entry for a song, or None"""
+        return self.entries.get(normalize_song_key(song_name))
+
+    def has_file(self, song_name):
+        """Return the saved path if the song was downloaded and is still on disk"""
+        entry = self.get(song_name)
+        if entry and entry.get("status") == "downloaded" and entry.get("path"):
+            if os.path.exists(entry["path"]):
+                return entry["path"]
+        return None
+
+    def record(self, song_name, **fields):
+        """Merge fields into a song's entry and append the change to disk"""
+        key = normalize_song_key(song_name)
+        update = {"key": key, "song": song_name, "updated_at": time.time(), **fields}
+        with self.lock:
+            self.entries.setdefault(key, {}).update(update)
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(update) + "\n")
+            except Exception as e:
+                log_message(f"Error writing song index: {e}")
+
+class SearchCache:
+    """
+    On-disk cache mapping a normalized "title - artist" to the video a
+    ytsearch resolved to, with TTL expiry and LRU eviction. Lets retries and
+    re-downloads hand yt-dlp a direct URL instead of searching again.
+    """
+
+    def __init__(self, path=SEARCH_CACHE_FILE, ttl=SEARCH_CACHE_TTL,
+                 max_entries=SEARCH_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # Least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            for entry in sorted(data.values(), key=lambda e: e.get("used_at", 0)):
+                self.entries[entry["key"]] = entry
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log_message(f"Error reading search cache: {e}")
+
+    def get(self, song_name):
+        """Return the cached resolution for a song, or None on a miss"""
+        key = normalize_song_key(song_name)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and time.time() - entry["cached_at"] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry:
+                self.hits += 1
+                entry["used_at"] = time.time()
+                self.entries.move_to_end(key)
+            else:
+                self.misses += 1
+            log_message(f"Search cache {'hit' if entry else 'miss'} for '{song_name}' "
+                        f"(hits={self.hits}, misses={self.misses})")
+        return entry
+
+    def put(self, song_name, video_id, **metadata):
+        """Remember which video (and format) a song resolved to; returns the entry"""
+        key = normalize_song_key(song_name)
+        now = time.time()
+        with self.lock:
+            entry = self.entries[key] = {
+                "key": key,
+                "video_id": video_id,
+                "url": f"https://www.youtube.com/watch?v={video_id}",
+                "cached_at": now,
+                "used_at": now,
+                **metadata,
+            }
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self._save()
+        return entry
+
+    def invalidate(self, song_name):
+        """Drop a song's resolution, e.g. after its video failed to download"""
+        with self.lock:
+            if self.entries.pop(normalize_song_key(song_name), None) is not None:
+                self._save()
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(dict(self.entries), f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            log_message(f"Error writing search cache: {e}")
+
+def song_token_key(key):
+    """Word-order-insensitive form of a normalized key, so "Artist - Title" matches "Title - Artist" """
+    return " ".join(sorted(key.split()))
+
+def file_fingerprint(path, size):
+    """Cheap content hash: blake2b over the size and the first and last LIBRARY_HASH_CHUNK bytes"""
+    digest = hashlib.blake2b(str(size).encode("ascii"), digest_size=16)
+    with open(path, "rb") as f:
+        digest.update(f.read(LIBRARY_HASH_CHUNK))
+        if size > 2 * LIBRARY_HASH_CHUNK:
+            f.seek(-LIBRARY_HASH_CHUNK, os.SEEK_END)
+        digest.update(f.read(LIBRARY_HASH_CHUNK))
+    return digest.hexdigest()
+
+def read_audio_tags(path):
+    """
+    Return (title, artist) from the file's tags when mutagen is installed,
+    otherwise from a "Title - Artist" filename
+    """
+    mutagen = load_mutagen_module()
+    if mutagen is not None:
+        try:
+            audio = mutagen.File(path, easy=True)
+            if audio is not None and audio.tags:
+                title = (audio.tags.get("title") or [None])[0]
+                artist = (audio.tags.get("artist") or [None])[0]
+                if title:
+                    return title, artist
+        except Exception as e:
+            log_message(f"Cannot read tags of {path}: {e}", logging.DEBUG)
+    title, _, artist = os.path.splitext(os.path.basename(path))[0].partition(" - ")
+    return title, artist or None
+
+class LibraryIndex:
+    """
+    Index of the audio files already in the save folders, so a song is
+    recognised as present before a job is queued, whatever its file is
+    called. Each file is stored as [mtime_ns, size, normalized key, content
+    hash] in one compact JSON file. Rescans only stat files and re-read the
+    ones whose mtime or size changed.
+    """
+
+    def __init__(self, path=LIBRARY_INDEX_FILE):
+        self.path = path
+        self.files = {}  # Path -> (mtime_ns, size, key, fingerprint)
+        self.by_key = {}
+        self.by_tokens = {}
+        self.by_fingerprint = {}
+        self.lock = threading.Lock()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.files = {path: tuple(record) for path, record in json.load(f)["files"].items()}
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log_message(f"Error reading library index: {e}")
+        self._rebuild()
+
+    def lookup(self, song_name):
+        """Return the path of a library file for this song, or None"""
+        key = normalize_song_key(song_name)
+        path = self.by_key.get(key) or self.by_tokens.get(song_token_key(key))
+        if path and os.path.exists(path):
+            return path
+        return None
+
+    def scan(self, folders=None):
+        """Bring the index up to date with the save folders"""
+        if folders is None:
+            folders = [PRIMARY_SAVE_FOLDER, FALLBACK_SAVE_FOLDER, INTERNAL_SAVE_FOLDER]
+        start = time.time()
+        seen = set()
+        changed = 0
+        for folder in dict.fromkeys(os.path.realpath(folder) for folder in folders):
+            for path, stat in self._walk(folder):
+                seen.add(path)
+                record = self.files.get(path)
+                if record and record[0] == stat.st_mtime_ns and record[1] == stat.st_size:
+                    continue
+                try:
+                    record = self._describe(path, stat)
+                except OSError:
+                    continue
+                with self.lock:
+                    self.files[path] = record
+                changed += 1
+
+        with self.lock:
+            removed = [path for path in self.files if path not in seen and not os.path.exists(path)]
+            for path in removed:
+                del self.files[path]
+            if changed or removed:
+                self._rebuild()
+                self._save()
+        log_message(f"Library index: {len(self.files)} files ({changed} new or changed, "
+                    f"{len(removed)} removed) in {time.time() - start:.2f}s")
+
+    def add(self, path, song_name=None):
+        """
+        Index a freshly saved file. Returns the path of an existing file with
+        identical content instead, leaving the new file unindexed.
+        """
+        path = os.path.realpath(path)  # Same form as scan(); save folders may be symlinks
+        try:
+            stat = os.stat(path)
+            record = self._describe(path, stat, song_name)
+        except OSError as e:
+            log_message(f"Cannot index {path}: {e}")
+            return None
+        with self.lock:
+            duplicate = self.by_fingerprint.get(record[3])
+            if duplicate and duplicate != path and os.path.exists(duplicate) \
+                    and not os.path.samefile(duplicate, path):
+                return duplicate
+            self.files[path] = record
+            self._rebuild()
+            self._save()
+        return None
+
+    def _walk(self, folder):
+        """Yield (path, stat) for audio files below folder, skipping hidden files and folders"""
+        try:
+            entries = list(os.scandir(folder))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if not entry.name.startswith("."):
+                        yield from self._walk(entry.path)
+                elif entry.name.lower().endswith(AUDIO_EXTENSIONS) and not entry.name.startswith("."):
+                    yield entry.path, entry.stat()
+            except OSError:
+                continue
+
+    def _describe(self, path, stat, song_name=None):
+        if song_name is None:
+            title, artist = read_audio_tags(path)
+            song_name = f"{title} - {artist}" if artist else title
+        return (stat.st_mtime_ns, stat.st_size, normalize_song_key(song_name),
+                file_fingerprint(path, stat.st_size))
+
+    def _rebuild(self):
+        by_key, by_tokens, by_fingerprint = {}, {}, {}
+        for path, (_, _, key, fingerprint) in self.files.items():
+            by_key[key] = path
+            by_tokens[song_token_key(key)] = path
+            by_fingerprint[fingerprint] = path
+        self.by_key, self.by_tokens, self.by_fingerprint = by_key, by_tokens, by_fingerprint
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"files": self.files}, f, separators=(",", ":"))
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            log_message(f"Error writing library index: {e}")
+
+_song_index = None
+_song_index_lock = threading.Lock()
+_search_cache = None
+_library_index = None
+
+def get_song_index():
+    """Load the persistent song index on first use"""
+    global _song_index
+    with _song_index_lock:
+        if _song_index is None:
+            _song_index = SongIndex()
+        return _song_index
+
+def get_search_cache():
+    """Load the search-result cache on first use"""
+    global _search_cache
+    with _song_index_lock:
+        if _search_cache is None:
+            _search_cache = SearchCache()
+        return _search_cache
+
+def get_library_index():
+    """Load the library index on first use (call scan() to refresh it)"""
+    global _library_index
+    with _song_index_lock:
+        if _library_index is None:
+            _library_index = LibraryIndex()
+        return _library_index
+
+def find_existing_song(song_name):
+    """Path of a copy of the song we already have, per the song index or the library scan"""
+    return get_song_index().has_file(song_name) or get_library_index().lookup(song_name)
+
 def display_progress_bar(progress):
     """
     Displays a custom formatted progress bar with complex characters in green and black.
@@ -84,23 +764,208 @@ def display_progress_bar(progress):
 
     print(f"\rDOWNLOADING {bar} {percent_display}", end="", flush=True)
 
+class NotificationDispatcher:
+    """
+    Sends Termux notifications from a background thread so callers never
+    block on termux-notification. Pending updates are kept per notification
+    ID with the newest one winning, removals are batched into one spawn, and
+    calls are spaced at least `min_interval` seconds apart.
+    """
+
+    def __init__(self, min_interval=NOTIFICATION_MIN_INTERVAL):
+        self.min_interval = min_interval
+        self.pending = OrderedDict()  # notification ID -> argv, or None to remove
+        self.cond = threading.Condition()
+        self.busy = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def post(self, notification_id, title, content, ongoing=False, priority=None,
+             button1=None, button1_action=None):
+        """Queue a notification, replacing any not-yet-sent update for the same ID"""
+        argv = ["termux-notification", "--id", str(notification_id),
+                "--title", title, "--content", content]
+        if button1:
+            argv += ["--button1", button1, "--button1-action", button1_action]
+        if ongoing:
+            argv += ["--ongoing", "true"]
+        if priority:
+            argv += ["--priority", priority]
+        self._queue(notification_id, argv)
+
+    def remove(self, *notification_ids):
+        """Queue removal of one or more notifications"""
+        for notification_id in notification_ids:
+            self._queue(notification_id, None)
+
+    def _queue(self, notification_id, argv):
+        with self.cond:
+            key = str(notification_id)
+            self.pending.pop(key, None)  # Re-append so ordering follows the latest call
+            self.pending[key] = argv
+            self.cond.notify()
+
+    def flush(self, timeout=10):
+        """Wait until everything queued so far has been sent"""
+        deadline = time.time() + timeout
+        with self.cond:
+            while self.pending or self.busy:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def _run(self):
+        last_call = 0
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                # Send every pending removal at once, or else the oldest update
+                removals = [key for key, argv in self.pending.items() if argv is None]
+                if removals:
+                    for key in removals:
+                        del self.pending[key]
+                    argv = None
+                else:
+                    key, argv = self.pending.popitem(last=False)
+                self.busy = True
+
+            wait = last_call + self.min_interval - time.time()
+            if wait > 0:
+                time.sleep(wait)
+
+            try:
+                if argv is None:
+                    script = "; ".join(f"termux-notification-remove {key}" for key in removals)
+                    subprocess.run(["sh", "-c", script], check=False)
+                else:
+                    subprocess.run(argv, check=False)
+            except Exception as e:
+                log_message(f"Error sending notification: {e}")
+            last_call = time.time()
+
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
+
+_notifier = None
+_notifier_lock = threading.Lock()
+
+def get_notifier():
+    """Start the notification dispatcher on first use"""
+    global _notifier
+    with _notifier_lock:
+        if _notifier is None:
+            _notifier = NotificationDispatcher()
+            # Short-lived processes (--download) must not exit with updates queued
+            atexit.register(_notifier.flush)
+        return _notifier
+
 def check_termux_api():
     """Check if Termux API is installed"""
-    try:
-        # Try to directly use termux-notification with a simple command
-        result = subprocess.run(["termux-notification", "--help"], 
-                              capture_output=True, text=True)
+    if get_capabilities().tool("termux-notification"):
         return True
-    except FileNotFoundError:
-        log_message("⚠️ Termux API not found. Please install it with: pkg install termux-api")
-        return False
-    except Exception as e:
-        log_message(f"⚠️ Error checking Termux API: {e}")
-        return False
+    log_message("⚠️ Termux API not found. Please install it with: pkg install termux-api")
+    return False
+
+class NotificationWatcher:
+    """
+    Polls the notification shade and yields only Shazam notifications that
+    weren't there on the previous poll. Unchanged output is detected by hash
+    and never parsed, and the poll interval backs off while nothing happens
+    and snaps back to the fast cadence after a hit.
+    """
+
+    def __init__(self, command=None, package=SHAZAM_PACKAGE, min_interval=POLL_INTERVAL_MIN,
+                 max_interval=POLL_INTERVAL_MAX, backoff=POLL_BACKOFF_FACTOR):
+        self.command = command or NOTIFICATION_LIST_CMD
+        self.package = package
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.last_digest = None
+        self.visible = set()  # Identity of every Shazam notification on the last poll
+        self.stop_event = threading.Event()
+        self.polls = 0
+        self.parses = 0
+
+    def mark_hit(self):
+        """Poll at the fast cadence again, e.g. right after a detection"""
+        self.interval = self.min_interval
 
-def listen_for_shazam():
+    def stop(self):
+        self.stop_event.set()
+
+    def poll(self):
+        """
+        Runs the list command once and returns the Shazam notifications that
+        are new since the last poll. Raises RuntimeError or ValueError on
+        command errors, or output that is not a JSON list.
+        """
+        output = subprocess.run(self.command, capture_output=True)
+        self.polls += 1
+        if output.returncode != 0:
+            raise RuntimeError(f"Error running {' '.join(self.command)}: "
+                               f"{output.stderr.decode('utf-8', 'replace')}")
+
+        digest = hashlib.blake2b(output.stdout, digest_size=16).digest()
+        if digest == self.last_digest:
+            return []
+
+        try:
+            notifications = json.loads(output.stdout)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"JSON Parsing Error: {e}; raw output: {output.stdout[:100]!r}")
+        if not isinstance(notifications, list):
+            raise ValueError(f"Expected a list of notifications, got: {output.stdout[:100]!r}")
+        self.last_digest = digest
+        self.parses += 1
+
+        current = {}
+        for notif in notifications:
+            if not isinstance(notif, dict) or notif.get("packageName") != self.package:
+                continue
+            # Shazam reuses one notification for each new song, so its text is
+            # part of the identity as well as the key/id
+            identity = (notif.get("key") or notif.get("id"), notif.get("title"), notif.get("content"))
+            current[identity] = notif
+
+        new = [notif for identity, notif in current.items() if identity not in self.visible]
+        self.visible = set(current)
+        return new
+
+    def watch(self):
+        """Yield new Shazam notifications until stop() is called"""
+        while not self.stop_event.is_set():
+            try:
+                new = self.poll()
+            except (RuntimeError, ValueError, OSError) as e:
+                log_message(f"❌ {e}")
+                self.stop_event.wait(5)
+                continue
+            except Exception as e:
+                # Anything unexpected must not end the generator and the listener with it
+                log_message(f"❌ Error polling notifications: {e}")
+                log_message(traceback.format_exc(), logging.DEBUG)
+                self.stop_event.wait(5)
+                continue
+
+            if new:
+                self.mark_hit()
+            for notif in new:
+                yield notif
+
+            self.stop_event.wait(self.interval)
+            if not new:
+                self.interval = min(self.max_interval, self.interval * self.backoff)
+
+def listen_for_shazam(watcher=None):
     """
-    Continuously listens for new Shazam song detections.
+    Continuously listens for new Shazam song detections. Returns once the
+    watcher is stopped (pass your own NotificationWatcher to control that).
     """
     log_message("\n🎧 Listening for Shazam song detection...\n")
     
@@ -108,376 +973,1053 @@ def listen_for_shazam():
         log_message("❌ Cannot proceed without Termux API")
         return
 
-    while True:
+    # Start the long-lived download worker; notification buttons only enqueue
+    daemon = DownloadDaemon()
+    daemon.start()
+    start_transcoder()
+
+    song_index = get_song_index()
+    watcher = watcher or NotificationWatcher()
+
+    # Catch up with files added to the Music folder since the last run
+    threading.Thread(target=get_library_index().scan, daemon=True).start()
+
+    for notif in watcher.watch():
         try:
-            output = subprocess.run(["termux-notification-list"], capture_output=True, text=True)
-            
-            if output.returncode != 0:
-                log_message(f"Error running termux-notification-list: {output.stderr}")
-                time.sleep(5)
-                continue
-                
-            try:
-                notifications = json.loads(output.stdout)
-            except json.JSONDecodeError as e:
-                log_message(f"❌ JSON Parsing Error: {e}")
-                log_message(f"Raw output: {output.stdout[:100]}")  # Log first 100 chars to debug
-                time.sleep(5)
-                continue
+            title = notif.get("title", "").strip()
+            content = notif.get("content", "").strip()
+
+            if title and content:
+                song_name = f"{title} - {content}"
+
+                if song_name not in detected_songs:
+                    detected_songs.add(song_name)  # Mark as detected
 
-            for notif in notifications:
-                if notif.get("packageName") == "com.shazam.android":
-                    title = notif.get("title", "").strip()
-                    content = notif.get("content", "").strip()
-
-                    if title and content:
-                        song_name = f"{title} - {content}"
-
-                        if song_name not in detected_songs:
-                            detected_songs.add(song_name)  # Mark as detected
-                            log_message(f"\n🎵 Detected Song: {song_name}")
-
-                            # Remove previous notifications to keep it clean
-                            try:
-                                subprocess.run(["termux-notification-remove", "101"], check=False)
-                                subprocess.run(["termux-notification-remove", "201"], check=False)
-                                subprocess.run(["termux-notification-remove", "202"], check=False)
-                            except Exception as e:
-                                log_message(f"Error removing notifications: {e}")
-
-                            # Notify user with a download option
-                            try:
-                                subprocess.run([
-                                    "termux-notification",
-                                    "--id", "200",
-                                    "--title", "Song Detected ",
-                                    "--content", f" '{song_name}'?",
-                                    "--button1", "Download",
-                                    "--button1-action", f"python {os.path.abspath(sys.argv[0])} --download \"{song_name}\"",
-                                    "--priority", "high"
-                                ])
-                            except Exception as e:
-                                log_message(f"Error creating notification: {e}")
-
-            time.sleep(2)  # Short delay before checking again
+                    existing_file = find_existing_song(song_name)
+                    if existing_file:
+                        log_message(f"\n🎵 Detected Song: {song_name} (already have it: {existing_file})")
+                        continue
+
+                    log_message(f"\n🎵 Detected Song: {song_name}")
+                    # This detection is the one the metrics measure from, even
+                    # when the song was seen (and maybe failed) in an earlier run
+                    detection = {"detected_at": time.time(), "title": title, "artist": content}
+                    if not song_index.get(song_name):
+                        detection["status"] = "detected"
+                    song_index.record(song_name, **detection)
+
+                    # Remove previous notifications to keep it clean
+                    notifier = get_notifier()
+                    notifier.remove(101, 201, 202)
+
+                    # Notify user with a download option
+                    notifier.post(
+                        200, "Song Detected ", f" '{song_name}'?",
+                        button1="Download",
+                        button1_action=enqueue_command(song_name),
+                        priority="high")
+
+                    # Resolve the search while the user decides, so a tap
+                    # goes straight to the transfer
+                    if PREFETCH_ENABLED:
+                        get_prefetcher().submit(song_name)
 
         except Exception as e:
             log_message(f"❌ Error in listen_for_shazam: {e}")
             log_message(traceback.format_exc())
-            time.sleep(5)
+
+# Which yt-dlp engine to use: "api" (in-process), "cli" (subprocess) or
+# "auto" (api when the yt_dlp module is importable)
+DOWNLOAD_ENGINE = os.environ.get("SHAZAM_DL_ENGINE", "auto").lower()
+
+_yt_dlp_module = None
+
+def load_yt_dlp_module():
+    """Import the yt_dlp package on first use, returning None if unavailable"""
+    global _yt_dlp_module
+    if _yt_dlp_module is None:
+        try:
+            import yt_dlp
+            _yt_dlp_module = yt_dlp
+        except ImportError:
+            _yt_dlp_module = False
+    return _yt_dlp_module or None
+
+_mutagen_module = None
+
+def load_mutagen_module():
+    """Import the optional mutagen tagging library on first use, returning None if unavailable"""
+    global _mutagen_module
+    if _mutagen_module is None:
+        try:
+            import mutagen
+            _mutagen_module = mutagen
+        except ImportError:
+            _mutagen_module = False
+    return _mutagen_module or None
+
+def select_download_engine():
+    """Pick the download engine, falling back to the CLI if yt_dlp can't be imported"""
+    if DOWNLOAD_ENGINE == "cli":
+        return "cli"
+    if load_yt_dlp_module() is not None:
+        return "api"
+    if DOWNLOAD_ENGINE == "api":
+        log_message("yt_dlp module not importable, falling back to the yt-dlp CLI")
+    return "cli"
+
+class YtDlpFileLogger:
+    """Logger for yt_dlp.YoutubeDL that writes everything to the job's output file"""
+
+    def __init__(self, f_out):
+        self.f_out = f_out
+
+    def debug(self, msg):
+        self.f_out.write(msg + "\n")
+
+    def info(self, msg):
+        self.f_out.write(msg + "\n")
+
+    def warning(self, msg):
+        self.f_out.write(f"WARNING: {msg}\n")
+
+    def error(self, msg):
+        self.f_out.write(f"ERROR: {msg}\n")
 
 def check_yt_dlp():
     """Check if yt-dlp is installed and working"""
-    try:
-        version_output = subprocess.run(["yt-dlp", "--version"], 
-                                       capture_output=True, text=True, check=True)
-        log_message(f"Using yt-dlp version: {version_output.stdout.strip()}")
+    if select_download_engine() == "api":
+        log_message(f"Using yt_dlp module version: {load_yt_dlp_module().version.__version__}")
         return True
-    except (subprocess.CalledProcessError, FileNotFoundError) as e:
-        log_message(f"yt-dlp error: {e}")
+    # Only runs `yt-dlp --version` again after the binary changed (e.g. pip upgrade)
+    tool = get_capabilities().tool("yt-dlp", ["--version"])
+    if tool is None:
+        log_message("yt-dlp error: not installed or not working")
         return False
+    log_message(f"Using yt-dlp version: {tool['version']}")
+    return True
 
-def download_song(song_name):
+def run_json_command(command, timeout=10):
+    """Run a command that prints JSON (Termux:API style), returning None on any failure"""
+    try:
+        output = subprocess.run(command, capture_output=True, text=True, timeout=timeout)
+        if output.returncode != 0:
+            return None
+        return json.loads(output.stdout)
+    except (OSError, subprocess.TimeoutExpired, ValueError):
+        return None
+
+_network_state = {"type": None, "checked_at": 0}
+_network_lock = threading.Lock()
+
+def detect_network_type():
     """
-    Downloads a song using yt-dlp with real-time notifications and a custom progress bar.
+    Return "wifi", "mobile" or "unknown" from termux-wifi-connectioninfo and
+    termux-telephony-deviceinfo. The result is cached for NETWORK_RECHECK_INTERVAL
+    seconds so concurrent jobs don't each spawn the probes.
     """
-    log_message(f"\n📥 Downloading: {song_name}...")
-    
-    # Get the save folder - we do this every time in case storage permissions changed
-    SAVE_FOLDER = get_save_folder()
-    log_message(f"Save folder: {SAVE_FOLDER}")
+    with _network_lock:
+        if _network_state["type"] and time.time() - _network_state["checked_at"] < NETWORK_RECHECK_INTERVAL:
+            return _network_state["type"]
 
-    # Check for Termux API
-    if not check_termux_api():
-        log_message("❌ Cannot proceed without Termux API")
-        return
+        network_type = "unknown"
+        wifi = run_json_command(WIFI_INFO_CMD)
+        if isinstance(wifi, dict) and wifi.get("supplicant_state") == "COMPLETED" \
+                and wifi.get("ip") not in (None, "", "0.0.0.0"):
+            network_type = "wifi"
+        else:
+            telephony = run_json_command(TELEPHONY_INFO_CMD)
+            if isinstance(telephony, dict) and telephony.get("data_state") == "connected":
+                network_type = "mobile"
 
-    # Remove the song detection notification immediately
-    try:
-        subprocess.run(["termux-notification-remove", "200"], check=False)
-    except Exception as e:
-        log_message(f"Error removing notification: {e}")
+        if network_type != _network_state["type"]:
+            log_message(f"📶 Network type: {network_type}")
+        _network_state.update(type=network_type, checked_at=time.time())
+        return network_type
 
-    # Notify user about the download start
-    try:
-        subprocess.run([
-            "termux-notification",
-            "--id", "201",
-            "--title", "INITIALIZING",
-            "--content", f"://>  {song_name}",
-            "--ongoing", "true",
-            "--priority", "high"
-        ])
-    except Exception as e:
-        log_message(f"Error creating notification: {e}")
+def get_network_profile():
+    """Return (network_type, profile) for the current connection"""
+    network_type = detect_network_type()
+    return network_type, NETWORK_PROFILES.get(network_type, NETWORK_PROFILES["unknown"])
 
-    # Check if yt-dlp is installed
-    if not check_yt_dlp():
+def parse_size(size):
+    """Convert a yt-dlp style size such as "500K" or "1M" to bytes"""
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    size = str(size).strip().upper()
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(float(size))
+
+def use_aria2c(profile):
+    """Whether this profile should hand transfers to aria2c (when installed)"""
+    return bool(profile and profile.get("aria2c_args")) and get_capabilities().tool("aria2c") is not None
+
+def profile_cli_args(profile):
+    """yt-dlp command line options for a network profile"""
+    if not profile:
+        return []
+    args = [
+        "--concurrent-fragments", str(profile["concurrent_fragments"]),
+        "--http-chunk-size", profile["chunk_size"],
+    ]
+    if profile.get("rate_limit"):
+        args += ["--limit-rate", profile["rate_limit"]]
+    if use_aria2c(profile):
+        args += ["--downloader", "aria2c", "--downloader-args", f"aria2c:{profile['aria2c_args']}"]
+    return args
+
+def profile_ydl_opts(profile):
+    """yt_dlp.YoutubeDL options for a network profile"""
+    if not profile:
+        return {}
+    opts = {
+        "concurrent_fragment_downloads": profile["concurrent_fragments"],
+        "http_chunk_size": parse_size(profile["chunk_size"]),
+    }
+    if profile.get("rate_limit"):
+        opts["ratelimit"] = parse_size(profile["rate_limit"])
+    if use_aria2c(profile):
+        opts["external_downloader"] = {"default": "aria2c"}
+        opts["external_downloader_args"] = {"aria2c": shlex.split(profile["aria2c_args"])}
+    return opts
+
+def device_is_charging():
+    """Whether termux-battery-status reports the device as plugged in"""
+    status = run_json_command(BATTERY_STATUS_CMD)
+    if not isinstance(status, dict):
+        return False
+    return status.get("plugged", "UNPLUGGED") != "UNPLUGGED" or status.get("status") in ("CHARGING", "FULL")
+
+class Transcoder:
+    """
+    Background MP3 conversion for downloads kept in their native codec.
+    Up to TRANSCODE_WORKERS ffmpeg processes run under `nice -n 19`, and only
+    while the device is charging or no download is in progress. Pending
+    work is tracked in the song index, so it survives restarts.
+    """
+
+    def __init__(self, workers=TRANSCODE_WORKERS):
+        self.workers = workers
+        self.jobs = queue.Queue()
+        self.stop_event = threading.Event()
+
+    def start(self):
+        for entry in list(get_song_index().entries.values()):
+            if entry.get("transcode") == "pending" and entry.get("path"):
+                self.jobs.put((entry["song"], entry["path"]))
+        for _ in range(self.workers):
+            threading.Thread(target=self._work, daemon=True).start()
+        if self.jobs.qsize():
+            log_message(f"Transcoder ready, {self.jobs.qsize()} file(s) waiting")
+
+    def stop(self):
+        self.stop_event.set()
+        for _ in range(self.workers):
+            self.jobs.put(None)
+
+    def submit(self, song_name, path):
+        self.jobs.put((song_name, path))
+
+    def _device_available(self):
+        with _active_downloads_lock:
+            idle = _active_downloads["count"] == 0
+        return idle or device_is_charging()
+
+    def _work(self):
+        while not self.stop_event.is_set():
+            item = self.jobs.get()
+            if item is None:
+                break
+            while not self.stop_event.is_set() and not self._device_available():
+                self.stop_event.wait(TRANSCODE_RECHECK_INTERVAL)
+            if self.stop_event.is_set():
+                break
+            self.transcode(*item)
+
+    def transcode(self, song_name, path):
+        """Convert one file to MP3 next to the original, then replace it"""
+        song_index = get_song_index()
+        if not os.path.exists(path):
+            song_index.record(song_name, transcode=None)
+            return False
+
+        mp3_path = f"{os.path.splitext(path)[0]}.mp3"
+        tmp_path = mp3_path + ".part"
+        cmd = ["nice", "-n", "19", "ffmpeg", "-nostdin", "-loglevel", "error", "-y",
+               "-i", path, "-vn", "-codec:a", "libmp3lame", "-q:a", "0", "-f", "mp3", tmp_path]
+        log_message(f"🎛️ Transcoding to MP3: {path}")
         try:
-            subprocess.run([
-                "termux-notification",
-                "--id", "202",
-                "--title", "Download Error",
-                "--content", "yt-dlp not installed or not working. Run 'pip install -U yt-dlp' first.",
-                "--priority", "high"
-            ])
+            result = subprocess.run(cmd, capture_output=True, text=True)
+            if result.returncode != 0:
+                raise RuntimeError(result.stderr.strip()[-300:])
+            os.replace(tmp_path, mp3_path)
+            os.remove(path)
         except Exception as e:
-            log_message(f"Error creating notification: {e}")
-        return
+            log_message(f"Transcode failed for {path}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            song_index.record(song_name, transcode="failed")
+            finish_file(song_name, path)  # Tagging was held back for the MP3
+            return False
 
-    search_query = f"ytsearch:{song_name}"
+        song_index.record(song_name, path=mp3_path, size=os.path.getsize(mp3_path), transcode="done")
+        log_message(f"Transcoded: {mp3_path}")
+        finish_file(song_name, mp3_path)
+        return True
 
-    # Create a temporary file to capture the download output
-    output_file = os.path.join(os.path.expanduser("~"), "yt_dlp_output.txt")
-    
-    # Safer filename for output
-    safe_filename = re.sub(r'[\\/*?:"<>|]', "_", song_name)
-    output_path = os.path.join(SAVE_FOLDER, f"{safe_filename}.%(ext)s")
-    
-    log_message(f"Output path template: {output_path}")
+_transcoder = None
 
-    # Run yt-dlp with verbose output to help troubleshooting
-    cmd = [
-        "yt-dlp",
-        "-v",                           # Verbose output
-        "-x",                           # Extract audio
-        "--audio-format", "mp3",        # Convert to MP3
-        "--audio-quality", "0",         # Best quality
-        "--newline",                    # Force newlines for progress parsing
-        "--restrict-filenames",         # Restrict filenames to ASCII
-        "--no-mtime",                   # Don't use modification time
-        "--no-playlist",                # No playlists
-        "--force-overwrites",           # Overwrite if necessary
-        "-o", output_path,              # Output path
-        search_query                    # Search query
+# Number of downloads running in this process (the transcoder waits for zero)
+_active_downloads = {"count": 0}
+_active_downloads_lock = threading.Lock()
+
+def start_transcoder():
+    """Start the background transcode stage if MP3 conversion is enabled"""
+    global _transcoder
+    if TRANSCODE_TO_MP3 and _transcoder is None:
+        _transcoder = Transcoder()
+        _transcoder.start()
+    return _transcoder
+
+def split_song_name(song_name):
+    """Split a "Title - Artist" song name into (title, artist), splitting at the last dash"""
+    title, sep, artist = song_name.rpartition(" - ")
+    if not sep or not title:
+        return song_name, None
+    return title, artist
+
+def fetch_thumbnail(video_id):
+    """Download a video's thumbnail as JPEG bytes, or None"""
+    import urllib.request  # Only the tagging stage talks HTTP directly
+    url = THUMBNAIL_URL.format(video_id=video_id)
+    try:
+        with urllib.request.urlopen(url, timeout=THUMBNAIL_TIMEOUT) as response:
+            return response.read()
+    except Exception as e:
+        log_message(f"Cannot fetch thumbnail {url}: {e}", logging.DEBUG)
+        return None
+
+def write_tags_mutagen(path, tags, cover):
+    """Write tags and cover art in place with mutagen: ID3 for MP3, MP4 atoms, Vorbis comments for Ogg/FLAC"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".mp3":
+        from mutagen.id3 import ID3, ID3NoHeaderError, APIC, TIT2, TPE1, TXXX, WOAS
+        try:
+            id3 = ID3(path)
+        except ID3NoHeaderError:
+            id3 = ID3()
+        id3.setall("TIT2", [TIT2(encoding=3, text=tags["title"])])
+        if tags.get("artist"):
+            id3.setall("TPE1", [TPE1(encoding=3, text=tags["artist"])])
+        if tags.get("shazam_detected"):
+            id3.add(TXXX(encoding=3, desc="SHAZAM_DETECTED", text=tags["shazam_detected"]))
+        if tags.get("source_url"):
+            id3.setall("WOAS", [WOAS(url=tags["source_url"])])
+        if cover:
+            id3.setall("APIC", [APIC(encoding=3, mime="image/jpeg", type=3, desc="Cover", data=cover)])
+        id3.save(path, v2_version=3)
+    elif ext == ".m4a":
+        from mutagen.mp4 import MP4, MP4Cover
+        audio = MP4(path)
+        if audio.tags is None:
+            audio.add_tags()
+        audio["\xa9nam"] = [tags["title"]]
+        if tags.get("artist"):
+            audio["\xa9ART"] = [tags["artist"]]
+        for key in ("shazam_detected", "source_url"):
+            if tags.get(key):
+                audio[f"----:com.apple.iTunes:{key.upper()}"] = [tags[key].encode("utf-8")]
+        if cover:
+            audio["covr"] = [MP4Cover(cover, imageformat=MP4Cover.FORMAT_JPEG)]
+        audio.save()
+    elif ext in (".opus", ".ogg", ".flac"):
+        import base64
+        from mutagen.flac import FLAC, Picture
+        audio = load_mutagen_module().File(path)
+        if audio is None:
+            return False
+        if audio.tags is None:
+            audio.add_tags()
+        for key, value in tags.items():
+            audio[key.upper()] = [value]
+        if cover:
+            picture = Picture()
+            picture.type, picture.mime, picture.desc, picture.data = 3, "image/jpeg", "Cover", cover
+            if isinstance(audio, FLAC):
+                audio.clear_pictures()
+                audio.add_picture(picture)
+            else:
+                audio["METADATA_BLOCK_PICTURE"] = [base64.b64encode(picture.write()).decode("ascii")]
+        audio.save()
+    else:
+        return False
+    return True
+
+def write_tags_ffmpeg(path, tags, cover):
+    """
+    Write tags and cover art by remuxing the file with ffmpeg (streams are
+    copied, not re-encoded). ffmpeg can only attach pictures to MP3 and MP4,
+    and drops the custom keys in MP4, so the source URL also goes in the comment.
+    """
+    folder, name = os.path.split(path)
+    stem, ext = os.path.splitext(name)
+    if ext.lower() not in (".mp3", ".m4a", ".opus", ".ogg", ".flac"):
+        return False
+    tmp_path = os.path.join(folder, f".{stem}.tagging{ext}")
+    cover_path = None
+
+    cmd = ["ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", path]
+    if cover and ext.lower() in (".mp3", ".m4a"):
+        cover_path = tmp_path + ".jpg"
+        with open(cover_path, "wb") as f:
+            f.write(cover)
+        cmd += ["-i", cover_path, "-map", "0:a", "-map", "1:v", "-disposition:v", "attached_pic"]
+    else:
+        cmd += ["-map", "0"]
+    cmd += ["-c", "copy", "-map_metadata", "0"]
+    if tags.get("source_url"):
+        cmd += ["-metadata", f"comment={tags['source_url']}"]
+    for key, value in tags.items():
+        cmd += ["-metadata", f"{key}={value}"]
+    if ext.lower() == ".mp3":
+        cmd += ["-id3v2_version", "3"]
+    cmd.append(tmp_path)
+
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip()[-300:])
+        os.replace(tmp_path, path)
+    finally:
+        for leftover in (tmp_path, cover_path):
+            if leftover:
+                try:
+                    os.remove(leftover)
+                except OSError:
+                    pass
+    return True
+
+class MediaScanBatcher:
+    """
+    Tells Android's media scanner about finished files from a background
+    thread. Paths are collected for `delay` seconds after the first one
+    arrives and sent together: one termux-media-scan call for up to
+    `batch_size` files, or one shell running all the am broadcasts when
+    termux-media-scan isn't installed.
+    """
+
+    def __init__(self, delay=MEDIA_SCAN_DELAY, batch_size=MEDIA_SCAN_BATCH):
+        self.delay = delay
+        self.batch_size = batch_size
+        self.pending = []
+        self.cond = threading.Condition()
+        self.busy = False
+        self.hurry = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add(self, path):
+        with self.cond:
+            if path not in self.pending:
+                self.pending.append(path)
+            self.cond.notify_all()
+
+    def flush(self, timeout=10):
+        """Send everything queued so far without waiting out the delay, and wait until it's sent"""
+        deadline = time.time() + timeout
+        with self.cond:
+            self.hurry = True
+            self.cond.notify_all()
+            while self.pending or self.busy:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                # Let files finishing around the same time join this batch
+                deadline = time.time() + self.delay
+                while not self.hurry and len(self.pending) < self.batch_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                paths = self.pending[:self.batch_size]
+                del self.pending[:self.batch_size]
+                self.busy = True
+
+            try:
+                self.scan(paths)
+            except Exception as e:
+                log_message(f"Media scanner error: {e}")
+
+            with self.cond:
+                self.busy = False
+                if not self.pending:
+                    self.hurry = False
+                self.cond.notify_all()
+
+    def scan(self, paths):
+        if get_capabilities().tool("termux-media-scan"):
+            subprocess.run(["termux-media-scan", *paths], capture_output=True, check=False)
+        else:
+            script = "; ".join(
+                shlex.join(["am", "broadcast", "-a", MEDIA_SCANNER_ACTION, "-d", f"file://{path}"])
+                for path in paths)
+            subprocess.run(["sh", "-c", script], capture_output=True, check=False)
+        log_message(f"Sent media scanner request for {len(paths)} file(s)")
+
+class Tagger:
+    """
+    Post-download tagging stage. Up to TAG_WORKERS threads write the title
+    and artist from the Shazam detection, the detection time and the source
+    URL into each finished file and embed the video thumbnail as cover art,
+    with mutagen when it is installed and ffmpeg otherwise. Every file then
+    goes to the media scan batcher, whether tagging worked or not.
+    """
+
+    def __init__(self, workers=TAG_WORKERS):
+        self.jobs = queue.Queue()
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def submit(self, song_name, path):
+        self.jobs.put((song_name, path))
+
+    def drain(self, timeout=120):
+        """Wait until every submitted file is tagged and its media scan request sent"""
+        deadline = time.time() + timeout
+        with self.jobs.all_tasks_done:
+            while self.jobs.unfinished_tasks:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.jobs.all_tasks_done.wait(remaining)
+        return get_media_scanner().flush(max(0.0, deadline - time.time()))
+
+    def _work(self):
+        while True:
+            song_name, path = self.jobs.get()
+            try:
+                self.tag(song_name, path)
+            except Exception as e:
+                log_message(f"Tagging failed for {path}: {e}")
+            finally:
+                if os.path.exists(path):
+                    get_media_scanner().add(path)
+                self.jobs.task_done()
+
+    def tag(self, song_name, path):
+        """Write tags and cover art into one file; returns whether the file was changed"""
+        if not os.path.exists(path):
+            return False
+        if load_mutagen_module() is not None:
+            writer = write_tags_mutagen
+        elif get_capabilities().tool("ffmpeg"):
+            writer = write_tags_ffmpeg
+        else:
+            log_message("Not tagging: neither mutagen nor ffmpeg is installed", logging.DEBUG)
+            return False
+
+        entry = get_song_index().get(song_name) or {}
+        title, artist = split_song_name(song_name)
+        tags = {"title": entry.get("title") or title, "artist": entry.get("artist") or artist}
+        if entry.get("detected_at"):
+            tags["shazam_detected"] = time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(entry["detected_at"]))
+        video_id = entry.get("video_id")
+        if video_id:
+            tags["source_url"] = SOURCE_URL.format(video_id=video_id)
+        tags = {key: value for key, value in tags.items() if value}
+        cover = fetch_thumbnail(video_id) if video_id else None
+
+        if not writer(path, tags, cover):
+            return False
+        log_message(f"🏷️ Tagged: {path}" + (" (with cover art)" if cover else ""))
+        # The rewrite changed the file's size and hash; keep the library index in step
+        get_library_index().add(path, song_name)
+        return True
+
+_tagger = None
+_media_scanner = None
+_post_process_lock = threading.Lock()
+
+def get_media_scanner():
+    """Start the media scan batcher on first use"""
+    global _media_scanner
+    with _post_process_lock:
+        if _media_scanner is None:
+            _media_scanner = MediaScanBatcher()
+            atexit.register(_media_scanner.flush)
+        return _media_scanner
+
+def get_tagger():
+    """Start the tagging stage on first use"""
+    global _tagger
+    get_media_scanner()  # Registered first, so at exit the tagger drains before the last scan flush
+    with _post_process_lock:
+        if _tagger is None:
+            _tagger = Tagger()
+            # A --download process must not exit with files still untagged
+            atexit.register(_tagger.drain)
+        return _tagger
+
+def finish_file(song_name, path):
+    """Hand a finished file to the tagging stage, or straight to the media scanner"""
+    if TAGGING_ENABLED:
+        get_tagger().submit(song_name, path)
+    else:
+        get_media_scanner().add(path)
+
+class JobMetrics:
+    """
+    Stage timings for one download job. mark() closes the running stage and
+    starts the next; write() appends the record to METRICS_FILE as JSONL.
+    """
+
+    _write_lock = threading.Lock()
+
+    def __init__(self, job_id, song_name, enqueued_at=None, detected_at=None):
+        self.record = {"job_id": job_id, "song": song_name, "started_at": time.time(), "stages": {}}
+        if enqueued_at:
+            self.record["stages"]["queue_wait"] = max(0.0, self.record["started_at"] - enqueued_at)
+            if detected_at and detected_at <= enqueued_at:
+                self.record["detect_to_enqueue"] = enqueued_at - detected_at
+        self.current = None
+        self.current_start = None
+
+    def mark(self, stage):
+        """End the current stage (if any) and start `stage`; repeated marks are ignored"""
+        if stage == self.current:
+            return
+        now = time.monotonic()
+        if self.current:
+            stages = self.record["stages"]
+            stages[self.current] = stages.get(self.current, 0.0) + now - self.current_start
+        self.current = stage
+        self.current_start = now
+
+    def write(self, status, downloaded_bytes=None, **fields):
+        """Close the last stage and append the job's record to the metrics file"""
+        self.mark(None)
+        self.record.update(status=status, finished_at=time.time(), **fields)
+        self.record["total"] = self.record["finished_at"] - self.record["started_at"]
+        download_time = self.record["stages"].get("download")
+        if downloaded_bytes:
+            self.record["bytes"] = downloaded_bytes
+            if download_time:
+                self.record["throughput_bps"] = downloaded_bytes / download_time
+        try:
+            with JobMetrics._write_lock:
+                os.makedirs(os.path.dirname(METRICS_FILE), exist_ok=True)
+                with open(METRICS_FILE, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(self.record) + "\n")
+        except Exception as e:
+            log_message(f"Error writing metrics: {e}")
+        stages = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.record["stages"].items())
+        log_message(f"⏱️ Job {self.record['job_id']} {status} in {self.record['total']:.2f}s ({stages})")
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+def print_stats(window=STATS_WINDOW):
+    """Print stage timing percentiles over the most recent jobs in METRICS_FILE"""
+    try:
+        with open(METRICS_FILE, "r", encoding="utf-8") as f:
+            lines = f.readlines()[-window:]
+    except FileNotFoundError:
+        print("No metrics recorded yet")
+        return
+
+    records = []
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue
+    if not records:
+        print("No metrics recorded yet")
+        return
+
+    series = {}
+    for record in records:
+        for stage, seconds in record.get("stages", {}).items():
+            series.setdefault(stage, []).append(seconds)
+        for field in ("detect_to_enqueue", "total"):
+            if record.get(field) is not None:
+                series.setdefault(field, []).append(record[field])
+
+    ok = sum(1 for record in records if record.get("status") == "downloaded")
+    print(f"Last {len(records)} jobs: {ok} downloaded, {len(records) - ok} failed\n")
+    print(f"{'stage':<18}{'count':>6}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}")
+    order = ["detect_to_enqueue", "queue_wait", "search", "download", "postprocess", "finalize", "total"]
+    for name in order + sorted(set(series) - set(order)):
+        values = sorted(series.get(name, []))
+        if values:
+            print(f"{name:<18}{len(values):>6}" + "".join(
+                f"{percentile(values, pct):>8.2f}s" for pct in (50, 90, 99)) + f"{values[-1]:>8.2f}s")
+
+    throughput = sorted(record["throughput_bps"] for record in records if record.get("throughput_bps"))
+    if throughput:
+        print(f"\n{'throughput':<18}{len(throughput):>6}" + "".join(
+            f"{percentile(throughput, pct) / 1e6:>6.2f}M/s" for pct in (50, 90, 99)) + "  (bytes/s)")
+
+def make_job_temp_dir(save_folder, job_id):
+    """
+    Create a private folder for one job inside the save folder's hidden temp
+    area (same filesystem, so the final move is an atomic rename)
+    """
+    temp_root = os.path.join(save_folder, JOB_TEMP_DIRNAME)
+    job_dir = os.path.join(temp_root, job_id)
+    os.makedirs(job_dir, exist_ok=True)
+    # Keep the media scanner away from partial downloads
+    nomedia = os.path.join(temp_root, ".nomedia")
+    if not os.path.exists(nomedia):
+        open(nomedia, "w").close()
+    return job_dir
+
+def resolve_job_output(job_dir, reported_file=None):
+    """
+    Return the finished audio file in a job folder. Prefers the path the
+    engine reported; otherwise the folder only ever holds this job's files,
+    so the choice is unambiguous.
+    """
+    if reported_file and os.path.exists(reported_file) \
+            and os.path.dirname(os.path.abspath(reported_file)) == os.path.abspath(job_dir):
+        return reported_file
+
+    finished = [
+        entry for entry in os.scandir(job_dir)
+        if entry.is_file() and not entry.name.startswith(".")
+        and not entry.name.endswith(PARTIAL_SUFFIXES)
     ]
+    if not finished:
+        return None
+    # Extracted audio wins over leftover intermediates, then the largest file
+    finished.sort(key=lambda entry: (entry.name.lower().endswith(AUDIO_EXTENSIONS), entry.stat().st_size))
+    return finished[-1].path
+
+# Error text that decides how a failed attempt is retried
+_UNAVAILABLE_ERROR_RE = re.compile(
+    r"video unavailable|private video|not available|has been removed|been terminated|"
+    r"copyright|blocked it|confirm your age|members-only|premieres in", re.IGNORECASE)
+_NETWORK_ERROR_RE = re.compile(
+    r"timed? ?out|connection|network|name resolution|unreachable|http error (429|5\d\d)|"
+    r"incompleteread|errno (101|104|110|111|113)|ssl|unable to download|giving up after", re.IGNORECASE)
+# Watchdog kills: a stall while transferring, or a conversion that overran
+_WATCHDOG_ERROR_RE = re.compile(r"no output for|still running after", re.IGNORECASE)
+_POSTPROCESS_ERROR_RE = re.compile(r"postprocessing|ffmpeg|ffprobe|conversion failed", re.IGNORECASE)
+
+def classify_failure(error, stage=None):
+    """
+    Sort a failed attempt by how to retry it: "unavailable" (try another
+    video), "network" (retry and resume), "postprocess" or "extraction".
+    `stage` is the last stage the attempt reached.
+    """
+    error = error or ""
+    if _UNAVAILABLE_ERROR_RE.search(error):
+        return "unavailable"
+    if _POSTPROCESS_ERROR_RE.search(error):
+        return "postprocess"
+    if _NETWORK_ERROR_RE.search(error):
+        return "network"
+    if _WATCHDOG_ERROR_RE.search(error):
+        return "postprocess" if stage == "postprocess" else "network"
+    if stage == "postprocess":
+        return "postprocess"
+    if stage == "download":
+        return "network"  # Died mid-transfer without saying why
+    return "extraction"
+
+def retry_delay(attempt, base=RETRY_BASE_DELAY, cap=RETRY_MAX_DELAY):
+    """Exponential backoff with jitter: half of the delay is fixed, half random"""
+    import random  # Only needed once something fails
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def download_song(song_name, job_id=None, notification_id=201, result_notification_id=202,
+                  show_progress_bar=True, enqueued_at=None):
+    """
+    Downloads a song using yt-dlp with real-time notifications and a custom progress bar.
+    Concurrent jobs pass their own job_id and notification IDs so their output
+    buffers and notifications don't collide.
+    Returns True if the song was saved, False otherwise.
+    """
+    log_message(f"\n📥 Downloading: {song_name}...")
+
+    notifier = get_notifier()
+
+    # Skip songs we already downloaded, across restarts
+    song_index = get_song_index()
+    existing_file = find_existing_song(song_name)
+    if existing_file:
+        log_message(f"✅ Already have it: {existing_file}")
+        notifier.remove(200)
+        notifier.post(result_notification_id, "Already Downloaded ✓",
+                      f"'{song_name}' is already in your Music folder", priority="high")
+        return True
+
+    # Get the save folder; the cached choice is re-checked cheaply every time
+    # in case storage permissions changed
+    SAVE_FOLDER = get_save_folder()
+    log_message(f"Save folder: {SAVE_FOLDER}")
+
+    # Check for Termux API
+    if not check_termux_api():
+        log_message("❌ Cannot proceed without Termux API")
+        return False
+
+    # Remove the song detection notification immediately
+    notifier.remove(200)
+
+    # Notify user about the download start
+    notifier.post(notification_id, "INITIALIZING", f"://>  {song_name}",
+                  ongoing=True, priority="high")
+
+    # Check if yt-dlp is installed
+    if not check_yt_dlp():
+        notifier.post(result_notification_id, "Download Error",
+                      "yt-dlp not installed or not working. Run 'pip install -U yt-dlp' first.",
+                      priority="high")
+        return False
+
+    # Reuse a previous search resolution when we have one. A prefetch started
+    # at detection time lands in the search cache, so claim it first.
+    used_prefetch, prefetched_info = get_prefetcher().take(song_name) if PREFETCH_ENABLED else (False, None)
+    search_cache = get_search_cache()
+    cached = search_cache.get(song_name)
+    # (query, video_id) pairs to try in order; more search results are
+    # fetched when they run out
+    candidates = [(cached["url"], cached["video_id"]) if cached else (f"ytsearch:{song_name}", None)]
+
+    # Every job gets its own yt-dlp log file and metrics record
+    job_id = job_id or os.urandom(6).hex()
+    metrics = JobMetrics(job_id, song_name, enqueued_at=enqueued_at,
+                         detected_at=(song_index.get(song_name) or {}).get("detected_at"))
+    os.makedirs(JOB_OUTPUT_DIR, exist_ok=True)
+    output_file = os.path.join(JOB_OUTPUT_DIR, f"yt_dlp_{job_id}.txt")
+    log_message(f"yt-dlp output for this job: {output_file}")
+
+    # Safer filename for output. yt-dlp writes into a private per-job folder
+    # so the result is known exactly, then it is moved into place atomically.
+    safe_filename = re.sub(r'[\\/*?:"<>|]', "_", song_name)
+    try:
+        job_dir = make_job_temp_dir(SAVE_FOLDER, job_id)
+    except OSError as e:
+        # The cached save folder stopped being writable; probe again
+        log_message(f"Cannot write to {SAVE_FOLDER}: {e}")
+        get_capabilities().invalidate("save_folder")
+        SAVE_FOLDER = get_save_folder()
+        job_dir = make_job_temp_dir(SAVE_FOLDER, job_id)
+    output_path = os.path.join(job_dir, f"{safe_filename}.%(ext)s")
     
-    log_message(f"Running command: {' '.join(cmd)}")
-    
-    downloaded_file = None
-    
+    log_message(f"Output path template: {output_path}", logging.DEBUG)
+
+    # Both engines report progress through this callback so notifications
+    # behave the same regardless of how yt-dlp is driven
+    progress_state = {"last_update_time": 0, "last_progress": -1}
+
+    def report_progress(progress):
+        if show_progress_bar:
+            display_progress_bar(progress)
+
+        # Only update notification every 5% change or every 2 seconds
+        current_time = time.time()
+        if (abs(progress - progress_state["last_progress"]) >= 5 or
+                current_time - progress_state["last_update_time"] >= 2):
+
+            progress_state["last_progress"] = progress
+            progress_state["last_update_time"] = current_time
+
+            # Progress bar for notification
+            bar_length = 20
+            filled_length = int(bar_length * progress // 100)
+            bar = "█" * filled_length + "·" * (bar_length - filled_length)
+            indicator = "://>" if progress % 10 < 5 else ":\\>"
+
+            # Never blocks: the dispatcher keeps only the newest update per ID
+            notifier.post(notification_id, f"DOWNLOADING {progress:.1f}%", f"{indicator} [{bar}]",
+                          ongoing=True, priority="high")
+
+    engine = select_download_engine()
+    network_type, profile = get_network_profile()
+    log_message(f"Download engine: {engine}, network: {network_type}")
+    song_index.record(song_name, status="downloading")
+
+    failures = []  # One record per failed attempt, kept in the job's metrics
+    tried_videos = set()
+    finished_file = None
+    with _active_downloads_lock:
+        _active_downloads["count"] += 1
     try:
-        with open(output_file, "w", encoding="utf-8") as f_out:
-            process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                bufsize=1,  # Line buffered output
-                encoding="utf-8"
-            )
+        for attempt in range(1, RETRY_MAX_ATTEMPTS + 1):
+            search_query, candidate_video = candidates[0]
+            last_stage = {"stage": None}
 
-            # Track progress with less frequent notification updates
-            last_update_time = 0
-            last_progress = -1
-            
-            # Track if we're getting output
-            last_output_time = time.time()
-            
-            while process.poll() is None:
-                # Read output line by line with timeout protection
-                line = ""
-                try:
-                    # Use a smaller timeout to keep checking if process is alive
-                    line = process.stdout.readline()
-                    if line:
-                        last_output_time = time.time()
-                        f_out.write(line)
-                        f_out.flush()
-                    else:
-                        # No output, check if process is hanging
-                        if time.time() - last_output_time > 30:  # 30 seconds with no output
-                            log_message("No output for 30 seconds, process may be hanging")
-                            break
-                        time.sleep(0.1)  # Small sleep to prevent CPU thrashing
-                        continue
-                except Exception as e:
-                    log_message(f"Error reading output: {e}")
-                    time.sleep(0.5)
+            def on_stage(stage):
+                last_stage["stage"] = stage
+                metrics.mark(stage)
+
+            # The engines mark "download" and "postprocess" as yt-dlp reaches them
+            metrics.mark("search")
+            attempt_start = time.time()
+            if engine == "api":
+                return_code, downloaded_file, media_info = run_ytdlp_api(
+                    search_query, output_path, output_file, report_progress, profile=profile,
+                    on_stage=on_stage, info=prefetched_info)
+            else:
+                return_code, downloaded_file, media_info = run_ytdlp_cli(
+                    search_query, output_path, output_file, report_progress, profile=profile,
+                    on_stage=on_stage)
+            prefetched_info = None  # Only good for the video it was extracted from
+
+            if return_code == 0:
+                finished_file = resolve_job_output(job_dir, downloaded_file)
+                if finished_file:
+                    break
+                failure = "postprocess"  # yt-dlp succeeded but left no audio file
+            else:
+                failure = classify_failure(media_info.get("error"), last_stage["stage"])
+
+            error = media_info.get("error") or f"yt-dlp exited with code {return_code}"
+            video_id = media_info.get("video_id")
+            failures.append({"attempt": attempt, "query": search_query, "video_id": video_id,
+                             "failure": failure, "error": error[-300:],
+                             "seconds": round(time.time() - attempt_start, 2)})
+            log_message(f"Attempt {attempt}/{RETRY_MAX_ATTEMPTS} for '{song_name}' failed ({failure}): {error}")
+            if attempt == RETRY_MAX_ATTEMPTS:
+                break
+
+            # A second postprocess failure means ffmpeg will keep failing
+            if failure == "postprocess" and sum(f["failure"] == "postprocess" for f in failures) > 1:
+                break
+            # Unavailable videos, and extraction that failed twice on the same
+            # video, move on to the next search result
+            if failure == "unavailable" or (failure == "extraction" and sum(
+                    f["query"] == search_query and f["failure"] == "extraction" for f in failures) > 1):
+                tried_videos.update((video_id, candidate_video))
+                if cached and search_query == cached["url"]:
+                    search_cache.invalidate(song_name)
+                    cached = None
+                candidates.pop(0)
+                if not candidates:
+                    try:
+                        results = search_videos(song_name, SEARCH_CANDIDATES)
+                    except Exception as e:
+                        log_message(f"Search failed for '{song_name}': {e}")
+                        results = []
+                    candidates = [(f"https://www.youtube.com/watch?v={result[0]}", result[0])
+                                  for result in results if result[0] not in tried_videos]
+                if not candidates:
+                    log_message(f"No other search results to try for '{song_name}'")
+                    break
+                log_message(f"Trying the next search result: {candidates[0][0]}")
+                # Partial data in the job folder belongs to the previous video
+                shutil.rmtree(job_dir, ignore_errors=True)
+                os.makedirs(job_dir, exist_ok=True)
+                if failure == "unavailable":
                     continue
-                
-                # Look for progress
-                match = re.search(r"\[download\]\s+(\d+\.\d+)%", line)
-                if match:
-                    progress = float(match.group(1))
-                    display_progress_bar(progress)
-                    
-                    # Only update notification every 5% change or every 2 seconds
-                    current_time = time.time()
-                    if (abs(progress - last_progress) >= 5 or 
-                        current_time - last_update_time >= 2):
-                        
-                        last_progress = progress
-                        last_update_time = current_time
-                        
-                        # Progress bar for notification
-                        bar_length = 20
-                        filled_length = int(bar_length * progress // 100)
-                        bar = "█" * filled_length + "·" * (bar_length - filled_length)
-                        indicator = "://>" if progress % 10 < 5 else ":\\>"
-                        
-                        try:
-                            subprocess.run([
-                                "termux-notification",
-                                "--id", "201",
-                                "--title", f"DOWNLOADING {progress:.1f}%",
-                                "--content", f"{indicator} [{bar}]",
-                                "--ongoing", "true",
-                                "--priority", "high"
-                            ])
-                        except Exception as e:
-                            log_message(f"Error updating notification: {e}")
-                
-                # Look for destination filename
-                dest_match = re.search(r"\[download\] Destination: (.+)", line)
-                if dest_match:
-                    downloaded_file = dest_match.group(1)
-                    log_message(f"Detected destination file: {downloaded_file}")
-                
-                # Also catch merger destination
-                merger_match = re.search(r"\[Merger\].+: (.+)", line)
-                if merger_match:
-                    potential_file = merger_match.group(1)
-                    if os.path.exists(potential_file):
-                        downloaded_file = potential_file
-                        log_message(f"Detected merged file: {downloaded_file}")
-                        
-                # Look for finished files (merging formats)
-                finished_match = re.search(r"\[ffmpeg\] Merging formats into \"(.+)\"", line)
-                if finished_match:
-                    potential_file = finished_match.group(1)
-                    if os.path.exists(potential_file):
-                        downloaded_file = potential_file
-                        log_message(f"Detected finished file: {downloaded_file}")
-                        
-                # Look for ExtractAudio destinations (important for MP3 conversion)
-                extract_match = re.search(r"\[ExtractAudio\] Destination: (.+)", line)
-                if extract_match:
-                    potential_file = extract_match.group(1)
-                    # Don't check if exists yet, as this is a destination file that might not exist yet
-                    downloaded_file = potential_file
-                    log_message(f"Detected audio extraction destination: {downloaded_file}")
-
-        # Wait for process to finish with timeout
-        try:
-            return_code = process.wait(timeout=300)  # 5 minute timeout
-            log_message(f"yt-dlp process returned with code {return_code}")
-        except subprocess.TimeoutExpired:
-            log_message("Process timed out after 5 minutes, killing it")
-            process.kill()
-            return_code = -1
 
-    except Exception as e:
-        log_message(f"Exception during download: {e}")
-        log_message(traceback.format_exc())
-        return_code = -1
-        
+            # Network and extraction errors are often transient; wait, then
+            # retry and let yt-dlp continue from the .part file
+            delay = retry_delay(attempt)
+            log_message(f"Retrying '{song_name}' in {delay:.1f}s")
+            notifier.post(notification_id, f"RETRYING IN {delay:.0f}s",
+                          f"://>  {song_name} ({failure} error, attempt {attempt + 1}/{RETRY_MAX_ATTEMPTS})",
+                          ongoing=True, priority="high")
+            progress_state["last_progress"] = -1
+            metrics.mark("backoff")
+            time.sleep(delay)
     finally:
+        with _active_downloads_lock:
+            _active_downloads["count"] -= 1
         # Make sure to remove the progress notification regardless of outcome
-        try:
-            subprocess.run(["termux-notification-remove", "201"], check=False)
-        except Exception:
-            pass
+        notifier.remove(notification_id)
 
-    # If we didn't find a downloaded file but the return code was successful,
-    # try to locate file by pattern (more thorough search)
-    if return_code == 0:
-        log_message("Searching for downloaded file based on pattern...")
+    # Move the finished file from the job folder into the save folder; no
+    # scanning of the (possibly huge) Music folder needed
+    metrics.mark("finalize")
+    file_exists = False
+    if finished_file:
         try:
-            found_file = False
-            for file in os.listdir(SAVE_FOLDER):
-                file_lower = file.lower()
-                if safe_filename.lower() in file_lower:
-                    if file_lower.endswith('.mp3'):
-                        downloaded_file = os.path.join(SAVE_FOLDER, file)
-                        log_message(f"Found MP3 file: {downloaded_file}")
-                        found_file = True
-                        break
-            
-            # If we still haven't found the file, check if a file was recently created in the folder
-            if not found_file:
-                log_message("Checking for recently created files...")
-                now = time.time()
-                most_recent_file = None
-                most_recent_time = 0
-                
-                for file in os.listdir(SAVE_FOLDER):
-                    if file.lower().endswith('.mp3'):
-                        file_path = os.path.join(SAVE_FOLDER, file)
-                        try:
-                            file_time = os.path.getmtime(file_path)
-                            if now - file_time < 60:  # File created in the last minute
-                                if file_time > most_recent_time:
-                                    most_recent_time = file_time
-                                    most_recent_file = file_path
-                        except Exception:
-                            pass
-                
-                if most_recent_file:
-                    downloaded_file = most_recent_file
-                    log_message(f"Found recently created file: {downloaded_file}")
-        except Exception as e:
-            log_message(f"Error searching for file: {e}")
-
-    # Check if file exists - add additional checks for MP3 conversion
-    if downloaded_file:
-        # Try with the original file path first
-        if os.path.exists(downloaded_file):
+            downloaded_file = os.path.join(SAVE_FOLDER, os.path.basename(finished_file))
+            os.replace(finished_file, downloaded_file)
             file_exists = True
-        else:
-            # If that doesn't exist, try with mp3 extension (common case)
-            base_name = os.path.splitext(downloaded_file)[0]
-            mp3_path = f"{base_name}.mp3"
-            if os.path.exists(mp3_path):
-                downloaded_file = mp3_path
+        except Exception as e:
+            # The save folder stopped being writable; probe again and move
+            # the file there (possibly across filesystems)
+            log_message(f"Error moving downloaded file into place: {e}")
+            get_capabilities().invalidate("save_folder")
+            SAVE_FOLDER = get_save_folder()
+            try:
+                downloaded_file = os.path.join(SAVE_FOLDER, os.path.basename(finished_file))
+                shutil.move(finished_file, downloaded_file)
                 file_exists = True
-                log_message(f"Found converted MP3 file: {downloaded_file}")
-            else:
-                file_exists = False
-                
-        if file_exists:
-            file_size = os.path.getsize(downloaded_file)
-            log_message(f"\n✅ Download Complete! File saved at: {downloaded_file}")
-            log_message(f"File size: {file_size} bytes")
-        
+            except Exception as e:
+                log_message(f"Error moving downloaded file to {SAVE_FOLDER}: {e}")
+    if file_exists or not finished_file:
+        shutil.rmtree(job_dir, ignore_errors=True)
+    else:
+        log_message(f"Keeping the downloaded file in {job_dir}")
+
+    if file_exists:
+        file_size = os.path.getsize(downloaded_file)
+        log_message(f"\n✅ Download Complete! File saved at: {downloaded_file}")
+        log_message(f"File size: {file_size} bytes")
+
         # Ensure file exists and has content
         if file_size == 0:
             log_message("Warning: File has zero size!")
-            
-        # Ensure file extension is .mp3
-        if not downloaded_file.lower().endswith('.mp3'):
-            base_name = os.path.splitext(downloaded_file)[0]
-            new_file = f"{base_name}.mp3"
-            try:
-                shutil.move(downloaded_file, new_file)
-                downloaded_file = new_file
-                log_message(f"Renamed to: {downloaded_file}")
-            except Exception as e:
-                log_message(f"Error renaming file: {e}")
-        
+
+        # The same audio may already be in the library under another name
+        duplicate = get_library_index().add(downloaded_file, song_name)
+        if duplicate and os.path.samefile(duplicate, downloaded_file):
+            duplicate = None  # The same file reached through another path, never delete it
+        if duplicate:
+            log_message(f"Identical file already in the library, keeping {duplicate}")
+            os.remove(downloaded_file)
+            downloaded_file = duplicate
+
         # Show completion notification
-        try:
-            subprocess.run([
-                "termux-notification",
-                "--id", "202",
-                "--title", "Download Complete ✓",
-                "--content", f"'{song_name}' saved to Music folder",
-                "--button1", "Open",
-                "--button1-action", f"termux-share {downloaded_file}",
-                "--priority", "high"
-            ])
-        except Exception as e:
-            log_message(f"Error creating completion notification: {e}")
+        notifier.post(result_notification_id, "Download Complete ✓",
+                      f"'{song_name}' saved to Music folder",
+                      button1="Open", button1_action=f"termux-share {shlex.quote(downloaded_file)}",
+                      priority="high")
         
-        # Make media scanner aware of new file
-        try:
-            subprocess.run([
-                "am", "broadcast", "-a", "android.intent.action.MEDIA_SCANNER_SCAN_FILE",
-                "-d", f"file://{downloaded_file}"
-            ])
-            log_message("Sent media scanner broadcast")
-        except Exception as e:
-            log_message(f"Media scanner error: {e}")
+        video_id = media_info.get("video_id")
+        if video_id and not cached:
+            search_cache.put(song_name, video_id, **{
+                k: media_info[k] for k in ("title", "duration", "format_id", "ext", "abr") if k in media_info})
+
+        # Native-codec files can be converted to MP3 later, off the hot path
+        transcode = None
+        if TRANSCODE_TO_MP3 and not downloaded_file.lower().endswith(".mp3"):
+            transcode = "pending"
+
+        song_index.record(song_name, status="downloaded", video_id=video_id,
+                          path=downloaded_file, size=file_size, downloaded_at=time.time(),
+                          transcode=transcode)
+        # Tagging and the media scan run off this thread; a file waiting for
+        # MP3 conversion is tagged once the transcoder is done with it, and
+        # an existing duplicate was handled when it was downloaded
+        if transcode and _transcoder is not None:
+            _transcoder.submit(song_name, downloaded_file)
+        elif not duplicate:
+            finish_file(song_name, downloaded_file)
+        metrics.write("downloaded", downloaded_bytes=media_info.get("downloaded_bytes"),
+                      engine=engine, network=network_type, cached_search=bool(cached),
+                      prefetched=used_prefetch, attempts=len(failures) + 1, failures=failures)
+        return True
     else:
         log_message("\n❌ Download failed or file not found")
         
@@ -489,46 +2031,1008 @@ def download_song(song_name):
         except Exception as e:
             log_message(f"Error reading output file: {e}")
         
+        notifier.post(result_notification_id, "Download Failed",
+                      f"Could not download '{song_name}'. Check logs.",
+                      button1="View Log", button1_action=f"termux-share {shlex.quote(LOG_FILE)}",
+                      priority="high")
+
+        if cached:
+            # The cached video may have been removed; search again next time
+            search_cache.invalidate(song_name)
+
+        song_index.record(song_name, status="failed", video_id=media_info.get("video_id"))
+        metrics.write("failed", engine=engine, network=network_type, cached_search=bool(cached),
+                      prefetched=used_prefetch, attempts=len(failures), failures=failures)
+        return False
+
+# --- yt-dlp output parsing ---------------------------------------------------
+#
+# yt-dlp prefixes nearly every line with a "[tag]". The parser looks at that
+# tag once and hands the rest of the line to the matching handler, so the
+# flood of "[debug]" and extractor lines under -v costs a dict lookup each.
+
+ProgressEvent = namedtuple("ProgressEvent", "percent total_bytes speed eta")
+DestinationEvent = namedtuple("DestinationEvent", "path")
+PostprocessEvent = namedtuple("PostprocessEvent", "processor phase path")  # phase: "start"/"end"
+MediaEvent = namedtuple("MediaEvent", "video_id format_id")
+ErrorEvent = namedtuple("ErrorEvent", "message")
+
+_NO_EVENTS = ()
+
+_SIZE_UNITS = {"B": 1, "KiB": 1024, "MiB": 1024 ** 2, "GiB": 1024 ** 3,
+               "KB": 1000, "MB": 1000 ** 2, "GB": 1000 ** 3}
+# " 42.0% of ~  3.52MiB at  1.52MiB/s ETA 00:02 (frag 3/7)"
+_PROGRESS_RE = re.compile(
+    r"\s*(\d+(?:\.\d+)?)% of\s+~?\s*([\d.]+)([KMG]?i?B)"
+    r"(?:\s+at\s+([\d.]+)([KMG]?i?B)/s)?(?:.*?\sETA\s+([\d:]+))?")
+# " dQw4w9WgXcQ: Downloading webpage"
+_YOUTUBE_ID_RE = re.compile(r" ([\w-]{11}): ")
+# " dQw4w9WgXcQ: Downloading 1 format(s): 251"
+_FORMAT_ID_RE = re.compile(r" ([\w-]{11}): Downloading \d+ format\(s\): (\S+)")
+# ' Merging formats into "Song.webm"', ' Correcting container of "Song.m4a"'
+_QUOTED_PATH_RE = re.compile(r'"(.+)"')
+
+# Postprocessors whose lines mean yt-dlp is converting rather than downloading
+_POSTPROCESSORS = frozenset((
+    "ExtractAudio", "Merger", "ffmpeg", "FixupM4a", "FixupM3u8", "FixupDuplicateMoov",
+    "FixupTimestamp", "FixupDuration", "Metadata", "EmbedThumbnail", "ThumbnailsConvertor",
+    "VideoConvertor", "VideoRemuxer", "SponsorBlock", "ModifyChapters"))
+
+def _parse_eta(eta):
+    seconds = 0
+    for part in eta.split(":"):
+        seconds = seconds * 60 + int(part)
+    return seconds
+
+class YtDlpOutputParser:
+    """
+    Single-pass parser for yt-dlp's console output (run with --newline).
+    feed() takes one line and returns a tuple of typed events; finish()
+    flushes the end of a postprocessing step still open at EOF. Used by the
+    CLI engine, and so by every queued and batch download that runs on it.
+    """
+
+    def __init__(self):
+        self.postprocessor = None  # Tag of the postprocessor currently running
+        self._handlers = {
+            "download": self._download,
+            "youtube": self._youtube,
+            "info": self._info,
+        }
+
+    def feed(self, line):
+        line = line.rstrip("\r\n")
+        if not line.startswith("["):
+            if line.startswith("ERROR:"):
+                return self._close_postprocess(ErrorEvent(line[6:].strip()))
+            if line.startswith("Deleting original file"):
+                return self._close_postprocess()
+            return _NO_EVENTS
+
+        end = line.find("]")
+        if end < 0:
+            return _NO_EVENTS
+        tag = line[1:end]
+        if tag == "debug":
+            return _NO_EVENTS
+
+        if tag in _POSTPROCESSORS:
+            rest = line[end + 1:]
+            if tag == self.postprocessor:
+                return _NO_EVENTS
+            events = self._close_postprocess()
+            self.postprocessor = tag
+            if rest.startswith(" Destination: "):
+                path = rest[14:]
+            elif rest.startswith(" Not converting audio "):
+                # " Not converting audio Song.opus; file is already in target format opus"
+                path = rest[22:].rpartition("; ")[0] or None
+            else:
+                match = _QUOTED_PATH_RE.search(rest)
+                path = match.group(1) if match else None
+            return events + (PostprocessEvent(tag, "start", path),)
+
+        handler = self._handlers.get(tag)
+        if handler is None:
+            return _NO_EVENTS
+        event = handler(line[end + 1:])
+        if event is None:
+            return _NO_EVENTS
+        return self._close_postprocess(event)
+
+    def finish(self):
+        return self._close_postprocess()
+
+    def _close_postprocess(self, event=None):
+        events = (event,) if event is not None else _NO_EVENTS
+        if self.postprocessor is None:
+            return events
+        closed = PostprocessEvent(self.postprocessor, "end", None)
+        self.postprocessor = None
+        return (closed,) + events
+
+    def _download(self, rest):
+        if rest.startswith(" Destination: "):
+            return DestinationEvent(rest[14:])
+        if rest.endswith(" has already been downloaded"):
+            return DestinationEvent(rest[1:-28])
+        match = _PROGRESS_RE.match(rest)
+        if not match:
+            return None
+        percent, size, unit, speed, speed_unit, eta = match.groups()
+        return ProgressEvent(
+            percent=float(percent),
+            total_bytes=int(float(size) * _SIZE_UNITS[unit]),
+            speed=float(speed) * _SIZE_UNITS[speed_unit] if speed else None,
+            eta=_parse_eta(eta) if eta else None)
+
+    def _youtube(self, rest):
+        match = _YOUTUBE_ID_RE.match(rest)
+        return MediaEvent(match.group(1), None) if match else None
+
+    def _info(self, rest):
+        match = _FORMAT_ID_RE.match(rest)
+        return MediaEvent(match.group(1), match.group(2)) if match else None
+
+def stop_process(process, grace=YTDLP_KILL_GRACE):
+    """
+    Terminate a process started with start_new_session=True along with
+    everything it spawned (ffmpeg, aria2c), then kill whatever is left of
+    its process group once it has exited or `grace` seconds have passed
+    """
+    def signal_group(sig):
         try:
-            subprocess.run([
-                "termux-notification",
-                "--id", "202",
-                "--title", "Download Failed",
-                "--content", f"Could not download '{song_name}'. Check logs.",
-                "--button1", "View Log",
-                "--button1-action", f"termux-share {LOG_FILE}",
-                "--priority", "high"
-            ])
-        except Exception as e:
-            log_message(f"Error creating failure notification: {e}")
+            os.killpg(process.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass  # The whole group is already gone
+
+    if process.poll() is None:
+        signal_group(signal.SIGTERM)
+        try:
+            process.wait(timeout=grace)
+        except subprocess.TimeoutExpired:
+            log_message(f"Process {process.pid} ignored SIGTERM, killing it")
+    # A leftover downloader must not keep writing the .part file a retry resumes
+    signal_group(signal.SIGKILL)
+    return process.wait()
+
+def run_ytdlp_cli(search_query, output_path, output_file, on_progress, profile=None,
+                  on_stage=None, inactivity_timeout=YTDLP_INACTIVITY_TIMEOUT,
+                  total_timeout=YTDLP_TOTAL_TIMEOUT):
+    """
+    Runs the yt-dlp command line tool and follows its output through
+    YtDlpOutputParser for progress and the output filename. The process is stopped if it prints nothing for
+    `inactivity_timeout` seconds before post-processing starts, or runs longer than `total_timeout`.
+    `profile` is a NETWORK_PROFILES entry with the transfer settings and
+    `on_stage` is called with "download"/"postprocess" as yt-dlp gets there.
+    Returns (return_code, downloaded_file, media_info).
+    """
+    on_stage = on_stage or (lambda stage: None)
+
+    # Run yt-dlp with verbose output to help troubleshooting
+    cmd = [
+        "yt-dlp",
+        *(["-v"] if YTDLP_VERBOSE else []),  # Verbose output when troubleshooting
+        "-x",                           # Extract audio
+        "--audio-format", AUDIO_CODEC,  # MP3, or "best" to keep the source codec
+        "--audio-quality", "0",         # Best quality
+        "--newline",                    # Force newlines for progress parsing
+        "--restrict-filenames",         # Restrict filenames to ASCII
+        "--no-mtime",                   # Don't use modification time
+        "--no-playlist",                # No playlists
+        "--continue",                   # Resume .part files left by a failed attempt
+        "--socket-timeout", str(inactivity_timeout),  # Fail stalled connections
+        *profile_cli_args(profile),     # Network-dependent transfer settings
+        "-o", output_path,              # Output path
+        search_query                    # Search query
+    ]
+    
+    log_message(f"Running command: {' '.join(cmd)}", logging.DEBUG)
+    
+    downloaded_file = None
+    media_info = {}
+    return_code = -1
+
+    parser = YtDlpOutputParser()
+    postprocessing = False
+
+    def handle_events(events):
+        nonlocal downloaded_file, postprocessing
+
+        for event in events:
+            if type(event) is ProgressEvent:
+                on_stage("download")
+                on_progress(event.percent)
+                media_info["downloaded_bytes"] = event.total_bytes
+            elif type(event) is DestinationEvent:
+                downloaded_file = event.path
+                log_message(f"Detected destination file: {downloaded_file}", logging.DEBUG)
+            elif type(event) is PostprocessEvent:
+                if event.phase != "start":
+                    continue
+                postprocessing = True
+                on_stage("postprocess")
+                if event.processor == "ExtractAudio" and event.path:
+                    # The converted file doesn't exist yet, but it's the one we want
+                    downloaded_file = event.path
+                    log_message(f"Detected audio extraction destination: {downloaded_file}", logging.DEBUG)
+                elif event.processor in ("Merger", "ffmpeg") and event.path and os.path.exists(event.path):
+                    downloaded_file = event.path
+                    log_message(f"Detected merged file: {downloaded_file}", logging.DEBUG)
+            elif type(event) is MediaEvent:
+                # Remember which video the search resolved to
+                media_info.setdefault("video_id", event.video_id)
+                if event.format_id:
+                    media_info.setdefault("format_id", event.format_id)
+            elif type(event) is ErrorEvent:
+                media_info["error"] = event.message
+                log_message(f"yt-dlp error: {event.message}")
+
+    try:
+        with open(output_file, "a", encoding="utf-8") as f_out:  # Retries append
+            process = subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,  # Own process group, so stop_process reaches ffmpeg/aria2c
+            )
+            fd = process.stdout.fileno()
+            selector = selectors.DefaultSelector()
+            selector.register(fd, selectors.EVENT_READ)
+
+            start_time = last_output_time = time.time()
+            pending = b""
+            stalled = None
+
+            # Read until EOF; select() wakes us at least once a second so the
+            # inactivity and total deadlines are enforced even when yt-dlp is silent
+            try:
+                while True:
+                    now = time.time()
+                    if not postprocessing and now - last_output_time > inactivity_timeout:
+                        stalled = f"No output for {inactivity_timeout} seconds"
+                        break
+                    if now - start_time > total_timeout:
+                        stalled = f"Still running after {total_timeout} seconds"
+                        break
+
+                    if not selector.select(timeout=1.0):
+                        continue
+                    chunk = os.read(fd, 65536)
+                    if not chunk:
+                        break  # EOF: yt-dlp exited
+
+                    last_output_time = time.time()
+                    lines = (pending + chunk).split(b"\n")
+                    pending = lines.pop()
+                    for raw_line in lines:
+                        line = raw_line.decode("utf-8", "replace")
+                        f_out.write(line + "\n")
+                        handle_events(parser.feed(line))
+            finally:
+                selector.close()
+
+            if pending:
+                line = pending.decode("utf-8", "replace")
+                f_out.write(line)
+                handle_events(parser.feed(line))
+            handle_events(parser.finish())
+
+            if stalled:
+                log_message(f"{stalled}, stopping yt-dlp")
+                media_info["error"] = stalled
+                stop_process(process)
+                return_code = -1
+            else:
+                # Output is closed, so the process is exiting; don't wait forever
+                try:
+                    return_code = process.wait(timeout=YTDLP_KILL_GRACE)
+                except subprocess.TimeoutExpired:
+                    stop_process(process)
+                    return_code = -1
+            process.stdout.close()
+            log_message(f"yt-dlp process returned with code {return_code}")
+
+    except Exception as e:
+        log_message(f"Exception during download: {e}")
+        log_message(traceback.format_exc())
+        if isinstance(e, OSError):
+            get_capabilities().invalidate("yt-dlp")  # Moved or uninstalled since it was probed
+        media_info["error"] = str(e)
+        return_code = -1
+
+    return return_code, downloaded_file, media_info
+
+def run_ytdlp_api(search_query, output_path, output_file, on_progress, profile=None, on_stage=None,
+                  info=None):
+    """
+    Drives yt_dlp.YoutubeDL in-process. Progress and the final filename come
+    straight from the hook dicts instead of parsed output. `info` is an
+    already extracted info dict (from SearchPrefetcher) to download without
+    extracting again.
+    Returns (return_code, downloaded_file, media_info).
+    """
+    yt_dlp = load_yt_dlp_module()
+    on_stage = on_stage or (lambda stage: None)
+    result = {"file": None}
+    media_info = {}
+
+    start_time = time.time()
+
+    def progress_hook(d):
+        # Stalled sockets are covered by socket_timeout; this enforces the total deadline
+        if time.time() - start_time > YTDLP_TOTAL_TIMEOUT:
+            raise TimeoutError(f"Still running after {YTDLP_TOTAL_TIMEOUT} seconds")
+
+        info = d.get("info_dict") or {}
+        if info.get("id") and "video_id" not in media_info:
+            media_info.update({
+                "video_id": info["id"],
+                "title": info.get("title"),
+                "duration": info.get("duration"),
+                "format_id": info.get("format_id"),
+                "ext": info.get("ext"),
+                "abr": info.get("abr"),
+            })
+        if d.get("status") == "downloading":
+            on_stage("download")
+            total = d.get("total_bytes") or d.get("total_bytes_estimate")
+            if total:
+                on_progress(100.0 * d.get("downloaded_bytes", 0) / total)
+        elif d.get("status") == "finished":
+            result["file"] = d.get("filename")
+            media_info["downloaded_bytes"] = d.get("total_bytes") or d.get("downloaded_bytes")
+            on_progress(100.0)
+
+    def postprocessor_hook(d):
+        if d.get("status") == "started":
+            on_stage("postprocess")
+        # Every postprocessor (ExtractAudio, MoveFiles, ...) reports the path it
+        # left the file at; the last one to finish is the final file
+        if d.get("status") == "finished":
+            filepath = d.get("info_dict", {}).get("filepath")
+            if filepath:
+                result["file"] = filepath
+                log_message(f"{d.get('postprocessor')} finished: {filepath}")
+
+    try:
+        with open(output_file, "a", encoding="utf-8") as f_out:  # Retries append
+            ydl_opts = {
+                "format": "bestaudio/best",
+                "postprocessors": [{
+                    "key": "FFmpegExtractAudio",
+                    "preferredcodec": AUDIO_CODEC,
+                    "preferredquality": "0",
+                }],
+                "outtmpl": output_path,
+                "restrictfilenames": True,
+                "updatetime": False,
+                "noplaylist": True,
+                "continuedl": True,  # Resume .part files left by a failed attempt
+                "socket_timeout": YTDLP_INACTIVITY_TIMEOUT,
+                "noprogress": True,
+                "verbose": YTDLP_VERBOSE,
+                "logger": YtDlpFileLogger(f_out),
+                "progress_hooks": [progress_hook],
+                "postprocessor_hooks": [postprocessor_hook],
+                **profile_ydl_opts(profile),
+            }
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                if info is not None:
+                    log_message(f"Running yt_dlp.YoutubeDL in-process with prefetched info for {search_query}")
+                    ydl.process_ie_result(info, download=True)
+                    return_code = 0  # Failures raise DownloadError
+                else:
+                    log_message(f"Running yt_dlp.YoutubeDL in-process for {search_query}")
+                    return_code = ydl.download([search_query])
+        log_message(f"yt-dlp finished with code {return_code}")
+    except Exception as e:
+        log_message(f"Exception during download: {e}")
+        log_message(traceback.format_exc())
+        media_info["error"] = str(e)
+        return_code = -1
+
+    downloaded_file = result["file"]
+    if downloaded_file:
+        log_message(f"Final file reported by yt-dlp: {downloaded_file}")
+    return return_code, downloaded_file, media_info
+
+def prune_job_logs(keep=JOB_LOGS_KEPT):
+    """Delete all but the newest `keep` per-job yt-dlp logs"""
+    try:
+        logs = sorted(os.scandir(JOB_OUTPUT_DIR), key=lambda entry: entry.stat().st_mtime)
+    except FileNotFoundError:
+        return
+    for entry in logs[:-keep] if keep else logs:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+def append_job_record(job_id, song_name, status, journal=JOB_JOURNAL):
+    """Append a job state change to the on-disk journal"""
+    record = {"id": job_id, "song": song_name, "status": status, "time": time.time()}
+    try:
+        os.makedirs(os.path.dirname(journal), exist_ok=True)
+        with open(journal, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+    except Exception as e:
+        log_message(f"Error writing job journal: {e}")
+
+def load_pending_jobs(journal=JOB_JOURNAL):
+    """
+    Replays the job journal and returns jobs that never finished (queued or
+    interrupted mid-download), oldest first. The journal is compacted so it
+    only holds those jobs afterwards.
+    """
+    jobs = {}
+    try:
+        with open(journal, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # Torn write from a crash
+                jobs.pop(record["id"], None)  # Keep insertion order = last update
+                jobs[record["id"]] = record
+    except FileNotFoundError:
+        return []
+    except Exception as e:
+        log_message(f"Error reading job journal: {e}")
+        return []
+
+    pending = [job for job in jobs.values() if job["status"] in ("queued", "running")]
+    pending.sort(key=lambda job: job["time"])
+
+    try:
+        tmp_path = journal + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for job in pending:
+                job["status"] = "queued"
+                f.write(json.dumps(job) + "\n")
+        os.replace(tmp_path, journal)
+    except Exception as e:
+        log_message(f"Error compacting job journal: {e}")
+
+    return pending
+
+class DownloadDaemon:
+    """
+    Long-lived download worker pool owned by the listener. Jobs arrive through
+    a FIFO (written by `--enqueue`) and are journaled to disk so they survive
+    a crash or restart. Up to `workers` jobs run concurrently. Batch imports
+    use their own journal and no FIFO.
+    """
+
+    def __init__(self, workers=MAX_CONCURRENT_DOWNLOADS, journal=JOB_JOURNAL, fifo=QUEUE_FIFO):
+        self.workers = workers
+        self.journal = journal
+        self.fifo = fifo
+        self.jobs = queue.Queue()
+        self.stop_event = threading.Event()
+        self.threads = []
+        self.lock = threading.Lock()
+        self.active = 0
+        self.queued_songs = set()  # Normalized keys of jobs not yet finished
+        self.succeeded = 0
+        self.failed = 0
+
+    def start(self):
+        """Create the FIFO, resume unfinished jobs and start worker threads"""
+        os.makedirs(STATE_DIR, exist_ok=True)
+        prune_job_logs()
+        if self.fifo and not os.path.exists(self.fifo):
+            os.mkfifo(self.fifo)
+
+        for job in load_pending_jobs(self.journal):
+            log_message(f"Resuming queued job: {job['song']}")
+            self.queued_songs.add(normalize_song_key(job["song"]))
+            self.jobs.put((job["id"], job["song"], job["time"]))
+
+        targets = [(self._read_fifo, ())] if self.fifo else []
+        targets += [(self._work, (slot,)) for slot in range(self.workers)]
+        for target, args in targets:
+            thread = threading.Thread(target=target, args=args, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+        log_message(f"Download daemon ready: {self.workers} worker(s), "
+                    f"{self.jobs.qsize()} job(s) queued")
+        self.update_summary()
+
+    def stop(self):
+        """Ask the workers to exit once their current job is done"""
+        self.stop_event.set()
+        for _ in range(self.workers):
+            self.jobs.put(None)
+
+    def wait_until_idle(self):
+        """Block until every queued job has finished"""
+        self.jobs.join()
+
+    def submit(self, song_name):
+        """Journal a new job and hand it to the pool, unless the song is already queued or running"""
+        key = normalize_song_key(song_name)
+        with self.lock:
+            if key in self.queued_songs:
+                log_message(f"Already queued: {song_name}")
+                return None
+            self.queued_songs.add(key)
+        job_id = os.urandom(6).hex()
+        append_job_record(job_id, song_name, "queued", self.journal)
+        self.jobs.put((job_id, song_name, time.time()))
+        log_message(f"Queued download: {song_name} ({self.jobs.qsize()} waiting)")
+        self.update_summary()
+        return job_id
+
+    def update_summary(self):
+        """Show an aggregate "N downloading, M queued" notification"""
+        with self.lock:
+            active = self.active
+        queued = self.jobs.qsize()
+        if active == 0 and queued == 0:
+            get_notifier().remove(SUMMARY_NOTIFICATION_ID)
+        else:
+            get_notifier().post(SUMMARY_NOTIFICATION_ID, "Shazam Downloads",
+                                f"{active} downloading, {queued} queued",
+                                ongoing=True, priority="low")
+
+    def _read_fifo(self):
+        """Accept enqueue requests written to the FIFO, one JSON object per line"""
+        # O_RDWR keeps a writer attached, so reads block instead of hitting EOF
+        fd = os.open(self.fifo, os.O_RDWR)
+        with os.fdopen(fd, "rb", buffering=0) as fifo:
+            while not self.stop_event.is_set():
+                line = fifo.readline()
+                if not line.strip():
+                    continue
+                try:
+                    song_name = json.loads(line)["song"].strip()
+                except (ValueError, KeyError, AttributeError) as e:
+                    log_message(f"Ignoring malformed queue entry {line[:100]!r}: {e}")
+                    continue
+                if song_name:
+                    self.submit(song_name)
+
+    def _wait_for_unmetered_network(self):
+        """
+        Hold workers while a large queue would drain over mobile data,
+        rechecking until Wi-Fi is back or the queue is small again
+        """
+        announced = False
+        while not self.stop_event.is_set():
+            with self.lock:
+                backlog = self.jobs.qsize() + self.active
+            network_type, _ = get_network_profile()
+            if network_type != "mobile" or backlog <= METERED_QUEUE_LIMIT:
+                if announced:
+                    log_message(f"Resuming downloads on {network_type}")
+                return
+            if not announced:
+                log_message(f"📶 On {network_type} with {backlog} jobs pending, "
+                            f"deferring downloads until Wi-Fi returns")
+                announced = True
+            self.stop_event.wait(NETWORK_RECHECK_INTERVAL)
+
+    def _work(self, slot):
+        """Run queued jobs, recording the outcome in the journal"""
+        while not self.stop_event.is_set():
+            self._wait_for_unmetered_network()
+            item = self.jobs.get()
+            if item is None:
+                break
+            job_id, song_name, enqueued_at = item
+            with self.lock:
+                self.active += 1
+            self.update_summary()
+            append_job_record(job_id, song_name, "running", self.journal)
+            try:
+                ok = download_song(
+                    song_name,
+                    job_id=job_id,
+                    notification_id=PROGRESS_NOTIFICATION_BASE + slot,
+                    result_notification_id=RESULT_NOTIFICATION_BASE + slot,
+                    # Interleaved terminal bars are unreadable with several workers
+                    show_progress_bar=self.workers == 1,
+                    enqueued_at=enqueued_at,
+                )
+            except Exception as e:
+                log_message(f"❌ Job {job_id} crashed: {e}")
+                log_message(traceback.format_exc())
+                ok = False
+            append_job_record(job_id, song_name, "done" if ok else "failed", self.journal)
+            with self.lock:
+                self.active -= 1
+                self.queued_songs.discard(normalize_song_key(song_name))
+                if ok:
+                    self.succeeded += 1
+                else:
+                    self.failed += 1
+            self.update_summary()
+            self.jobs.task_done()
+
+def enqueue_command(song_name):
+    """
+    Shell command for the notification's Download button. It runs the script
+    with `python -m` so Python loads the cached bytecode instead of
+    recompiling the whole file on every tap.
+    """
+    script_dir, script_file = os.path.split(os.path.abspath(__file__))
+    module = os.path.splitext(script_file)[0]
+    return (f"PYTHONPATH={shlex.quote(script_dir)} python -m {shlex.quote(module)} "
+            f"--enqueue {shlex.quote(song_name)}")
+
+def enqueue_song(song_name):
+    """
+    Hands a song to the running download daemon. Falls back to downloading
+    in this process when no daemon is listening on the FIFO.
+    """
+    existing_file = find_existing_song(song_name)
+    if existing_file:
+        log_message(f"✅ Already have it: {existing_file}")
+        notifier = get_notifier()
+        notifier.remove(200)
+        notifier.post(202, "Already Downloaded ✓",
+                      f"'{song_name}' is already in your Music folder", priority="high")
+        return True
+
+    message = (json.dumps({"song": song_name}) + "\n").encode("utf-8")
+    try:
+        # Non-blocking open fails with ENXIO instead of hanging when nobody reads
+        fd = os.open(QUEUE_FIFO, os.O_WRONLY | os.O_NONBLOCK)
+    except OSError as e:
+        if e.errno not in (errno.ENXIO, errno.ENOENT):
+            raise
+        log_message("No download daemon running, downloading directly")
+        return download_song(song_name)
+
+    try:
+        os.write(fd, message)  # Writes under PIPE_BUF are atomic
+    finally:
+        os.close(fd)
+    return True
+
+def search_videos(song_name, count=1):
+    """
+    Return up to `count` ytsearch results for a song as (video_id, title,
+    duration) tuples, without downloading anything
+    """
+    query = f"ytsearch{count}:{song_name}"
+    if select_download_engine() == "api":
+        ydl_opts = {
+            "quiet": True,
+            "no_warnings": True,
+            "extract_flat": "in_playlist",
+            "socket_timeout": YTDLP_INACTIVITY_TIMEOUT,
+        }
+        with load_yt_dlp_module().YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(query, download=False)
+        return [(entry.get("id"), entry.get("title"), entry.get("duration"))
+                for entry in info.get("entries") or [] if entry.get("id")]
+
+    output = subprocess.run(
+        ["yt-dlp", "--flat-playlist", "--print", "%(id)s\t%(title)s\t%(duration)s", query],
+        capture_output=True, text=True, timeout=YTDLP_TOTAL_TIMEOUT)
+    if output.returncode != 0:
+        parser = YtDlpOutputParser()
+        errors = [event.message for line in output.stderr.splitlines()
+                  for event in parser.feed(line) if type(event) is ErrorEvent]
+        raise RuntimeError(errors[-1] if errors else output.stderr.strip()[-200:])
+    results = [tuple((line.split("\t") + [None, None])[:3]) for line in output.stdout.splitlines()]
+    return [result for result in results if result[0]]
+
+def resolve_search(song_name):
+    """
+    Resolve a song to its first ytsearch result without downloading it,
+    going through the search cache. Returns the cache entry or None.
+    """
+    search_cache = get_search_cache()
+    cached = search_cache.get(song_name)
+    if cached:
+        return cached
+
+    try:
+        results = search_videos(song_name)
+    except Exception as e:
+        log_message(f"Search failed for '{song_name}': {e}")
+        return None
+
+    if not results:
+        return None
+    video_id, title, duration = results[0]
+    return search_cache.put(song_name, video_id, title=title, duration=duration)
+
+class SearchPrefetcher:
+    """
+    Speculatively resolves a detected song while its "Song Detected"
+    notification waits for a tap: the ytsearch result and the chosen audio
+    format go into the search cache, and with the in-process engine the whole
+    info dict is kept so the download can skip extraction. One resolution
+    runs at a time. Since the notification only ever offers the newest
+    detection, submitting a song cancels unfinished work for older ones.
+    """
+
+    def __init__(self, window=PREFETCH_WINDOW, max_entries=PREFETCH_MAX_ENTRIES):
+        self.window = window
+        self.max_entries = max_entries
+        self.jobs = OrderedDict()  # Normalized key -> job dict, oldest first
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, song_name):
+        key = normalize_song_key(song_name)
+        with self.lock:
+            self._expire()
+            if key in self.jobs:
+                return
+            for old_key, old_job in list(self.jobs.items()):
+                if not old_job["done"].is_set():
+                    self._cancel(old_key, old_job)
+            self.jobs[key] = {
+                "song": song_name,
+                "submitted_at": time.time(),
+                "done": threading.Event(),
+                "started": False,
+                "cancelled": False,
+                "process": None,
+                "info": None,
+            }
+            while len(self.jobs) > self.max_entries:
+                old_key, old_job = next(iter(self.jobs.items()))
+                self._cancel(old_key, old_job)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.pending.put((key, self.jobs[key]))
+
+    def take(self, song_name, timeout=PREFETCH_TAKE_TIMEOUT):
+        """
+        Claim a song's prefetch, waiting up to `timeout` seconds if it's still
+        running. Returns (prefetched, info): whether a prefetch ran to
+        completion for the song, and the extracted info dict (in-process
+        engine only) or None. A prefetch that hasn't started yet (the thread
+        is stuck in an older extraction) or is still running after the wait is
+        cancelled and the caller searches normally.
+        """
+        key = normalize_song_key(song_name)
+        with self.lock:
+            self._expire()
+            job = self.jobs.pop(key, None)
+            if job is not None and not job["started"]:
+                self._cancel(key, job)
+                return False, None
+        if job is None:
+            return False, None
+        if not job["done"].is_set():
+            log_message(f"Waiting for the prefetch of '{song_name}' to finish")
+            if not job["done"].wait(timeout):
+                with self.lock:
+                    self._cancel(key, job)
+                log_message(f"Prefetch of '{song_name}' still running after {timeout}s, searching instead")
+                return False, None
+        if job["cancelled"]:
+            return False, None
+        return True, job["info"]
+
+    def _cancel(self, key, job):
+        """Drop a job; call with self.lock held"""
+        job["cancelled"] = True
+        if self.jobs.get(key) is job:
+            del self.jobs[key]
+        if job["process"] is not None:
+            stop_process(job["process"], grace=1)
+        job["done"].set()
+        log_message(f"Cancelled prefetch for '{job['song']}'", logging.DEBUG)
+
+    def _expire(self):
+        """Forget results nobody claimed in time; call with self.lock held"""
+        deadline = time.time() - self.window
+        for key, job in list(self.jobs.items()):
+            if job["submitted_at"] < deadline:
+                self._cancel(key, job)
+
+    def _run(self):
+        while True:
+            key, job = self.pending.get()
+            with self.lock:
+                if job["cancelled"] or self.jobs.get(key) is not job:
+                    job["done"].set()  # Nobody waits on a skipped job
+                    continue
+                job["started"] = True
+            try:
+                self._resolve(job)
+            except Exception as e:
+                log_message(f"Prefetch failed for '{job['song']}': {e}")
+            finally:
+                job["done"].set()
+
+    def _resolve(self, job):
+        song_name = job["song"]
+        query = f"ytsearch1:{song_name}"
+        start = time.time()
+
+        if select_download_engine() == "api":
+            ydl_opts = {
+                "quiet": True,
+                "no_warnings": True,
+                "format": "bestaudio/best",
+                "noplaylist": True,
+                "socket_timeout": YTDLP_INACTIVITY_TIMEOUT,
+            }
+            with load_yt_dlp_module().YoutubeDL(ydl_opts) as ydl:
+                result = ydl.extract_info(query, download=False)
+            entries = list(result.get("entries") or [])
+            info = entries[0] if entries else None
+        else:
+            fields = ("id", "title", "duration", "format_id", "ext", "abr")
+            cmd = ["yt-dlp", "-f", "bestaudio/best", "--no-playlist",
+                   "--socket-timeout", str(YTDLP_INACTIVITY_TIMEOUT),
+                   "--print", "\t".join(f"%({field})s" for field in fields), query]
+            with self.lock:
+                if job["cancelled"]:
+                    return
+                job["process"] = subprocess.Popen(
+                    cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+                    start_new_session=True)
+            try:
+                output, _ = job["process"].communicate(timeout=YTDLP_TOTAL_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                stop_process(job["process"])
+                output = ""
+            values = output.strip().split("\n")[0].split("\t")
+            info = dict(zip(fields, values)) if len(values) == len(fields) else None
+
+        if job["cancelled"] or not info or not info.get("id"):
+            return
+        get_search_cache().put(
+            song_name, info["id"],
+            **{field: info.get(field) for field in ("title", "duration", "format_id", "ext", "abr")})
+        if "formats" in info:
+            job["info"] = info  # Full extraction result from the in-process engine
+        log_message(f"Prefetched '{song_name}' in {time.time() - start:.1f}s "
+                    f"(video {info['id']}, format {info.get('format_id')})")
+
+_prefetcher = None
+
+def get_prefetcher():
+    """Create the background search prefetcher on first use"""
+    global _prefetcher
+    with _song_index_lock:
+        if _prefetcher is None:
+            _prefetcher = SearchPrefetcher()
+        return _prefetcher
+
+def parse_track_list(path):
+    """
+    Read songs from a batch file and return them as "title - artist" strings.
+    Accepts plain text (one song per line, # for comments), CSV with
+    title/artist columns, and Shazam's exported library CSV (which has a
+    "Shazam Library" banner line before the header).
+    """
+    import csv  # Batch-only; kept off the startup path
+
+    with open(path, "r", encoding="utf-8-sig") as f:
+        lines = f.read().splitlines()
+
+    # Look for a CSV header with title and artist columns near the top
+    header_row = None
+    for i, line in enumerate(lines[:5]):
+        columns = [c.strip().strip('"').lower() for c in next(csv.reader([line]), [])]
+        if "title" in columns and "artist" in columns:
+            header_row = i
+            break
+
+    songs = []
+    if header_row is not None:
+        for row in csv.DictReader(lines[header_row:]):
+            row = {(k or "").strip().lower(): (v or "").strip() for k, v in row.items()}
+            if row.get("title") and row.get("artist"):
+                songs.append(f"{row['title']} - {row['artist']}")
+    elif path.lower().endswith(".csv"):
+        for row in csv.reader(lines):
+            if len(row) >= 2 and row[0].strip() and row[1].strip():
+                songs.append(f"{row[0].strip()} - {row[1].strip()}")
+    else:
+        for line in lines:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                songs.append(line)
+    return songs
+
+def run_batch(path, workers=MAX_CONCURRENT_DOWNLOADS):
+    """
+    Download every song in a track list through the concurrent pipeline.
+    Songs already in the library are skipped and the batch has its own job
+    journal, so re-running an interrupted import picks up where it stopped.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed  # Batch-only
+
+    try:
+        songs = parse_track_list(path)
+    except Exception as e:
+        log_message(f"❌ Cannot read batch file {path}: {e}")
+        return False
+
+    song_index = get_song_index()
+    get_library_index().scan()
+    batch_id = hashlib.blake2b(os.path.abspath(path).encode("utf-8"), digest_size=8).hexdigest()
+    daemon = DownloadDaemon(workers=workers,
+                            journal=os.path.join(BATCH_DIR, f"{batch_id}.jsonl"), fifo=None)
+    resumed = {normalize_song_key(job["song"]) for job in load_pending_jobs(daemon.journal)}
+    start_time = time.time()  # Before start(): resumed jobs count towards the summary too
+    daemon.start()
+    start_transcoder()
+
+    seen = set(resumed)
+    todo = []
+    skipped = 0
+    for song_name in songs:
+        key = normalize_song_key(song_name)
+        if key in seen:
+            continue
+        seen.add(key)
+        if find_existing_song(song_name):
+            skipped += 1
+            continue
+        todo.append(song_name)
+
+    log_message(f"📋 Batch {path}: {len(songs)} entries, {len(todo)} to download, "
+                f"{skipped} already downloaded, {len(resumed)} resumed")
+
+    # Resolve searches concurrently and start each download as soon as its
+    # search is done; unresolved songs still go through yt-dlp's own search
+    with ThreadPoolExecutor(max_workers=BATCH_RESOLVE_WORKERS) as pool:
+        futures = {pool.submit(resolve_search, song_name): song_name for song_name in todo}
+        for future in as_completed(futures):
+            daemon.submit(futures[future])
+
+    daemon.wait_until_idle()
+    daemon.stop()
+
+    # Tracks and bytes both cover the songs this run downloaded, resumed ones included
+    elapsed = max(time.time() - start_time, 1e-6)
+    downloaded_bytes = 0
+    for key in resumed | {normalize_song_key(song_name) for song_name in todo}:
+        entry = song_index.entries.get(key)
+        if entry and entry.get("status") == "downloaded" and entry.get("downloaded_at", 0) >= start_time:
+            downloaded_bytes += entry.get("size") or 0
+
+    log_message(f"📊 Batch finished in {elapsed:.1f}s: {daemon.succeeded} downloaded, "
+                f"{daemon.failed} failed, {skipped} skipped")
+    log_message(f"📊 Throughput: {daemon.succeeded * 60 / elapsed:.1f} tracks/min, "
+                f"{downloaded_bytes / 1e6:.1f} MB ({downloaded_bytes / elapsed / 1e6:.2f} MB/s)")
+    return daemon.failed == 0
 
 def main():
     """Main function to handle command line arguments and startup"""
+    # Enqueueing from a notification button must stay cheap: no folder probing,
+    # no log reset, no startup notification
+    if len(sys.argv) > 1 and sys.argv[1] == "--enqueue":
+        if len(sys.argv) > 2:
+            enqueue_song(sys.argv[2])
+        else:
+            log_message("Error: No song name provided for enqueue")
+        return
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--stats":
+        print_stats()
+        return
+
     # Get save folder only once at startup
     SAVE_FOLDER = get_save_folder()
     
-    # Initialize log file
-    try:
-        with open(LOG_FILE, "w", encoding="utf-8") as f:
-            f.write(f"=== Shazam Downloader Log Started at {time.strftime('%Y-%m-%d %H:%M:%S')} ===\n")
-            f.write(f"Python version: {sys.version}\n")
-            f.write(f"Script path: {os.path.abspath(sys.argv[0])}\n")
-            f.write(f"Save folder: {SAVE_FOLDER}\n")
-            f.write(f"Command line: {' '.join(sys.argv)}\n\n")
-    except Exception as e:
-        print(f"Error initializing log: {e}")
+    # Mark the start of this run; the log is appended to (and rotated by
+    # size), so the listener's history survives --download runs
+    log_message(f"=== Shazam Downloader started (pid {os.getpid()}) ===")
+    log_message(f"Python version: {sys.version}", logging.DEBUG)
+    log_message(f"Script path: {os.path.abspath(sys.argv[0])}", logging.DEBUG)
+    log_message(f"Save folder: {SAVE_FOLDER}")
+    log_message(f"Command line: {' '.join(sys.argv)}")
     
     # Show startup notification
-    try:
-        subprocess.run([
-            "termux-notification",
-            "--id", "101",
-            "--title", "Shazam Downloader Started",
-            "--content", "Listening for Shazam detections...",
-            "--ongoing", "true"
-        ])
-    except Exception as e:
-        log_message(f"Error creating startup notification: {e}")
+    get_notifier().post(101, "Shazam Downloader Started", "Listening for Shazam detections...",
+                        ongoing=True)
     
     # Handle command line arguments
     try:
@@ -537,6 +3041,11 @@ def main():
                 download_song(sys.argv[2])
             else:
                 log_message("Error: No song name provided for download")
+        elif len(sys.argv) > 1 and sys.argv[1] == "--batch":
+            if len(sys.argv) > 2:
+                run_batch(sys.argv[2])
+            else:
+                log_message("Error: No track list provided for batch")
         else:
             listen_for_shazam()
     except Exception as e: